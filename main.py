@@ -2,12 +2,12 @@
 import streamlit as st
 from openai import OpenAI
 import json
-import markdown2
 import requests
 from datetime import datetime
 import pytz
 
 from prompts import system_prompt_regular, system_prompt_essayist, system_prompt_expert
+from rendering import conversation_html, render_markdown, stream_renderer
 from embedchain import App
 from groq import Groq
 
@@ -165,13 +165,16 @@ def llm_call(model: str, messages: List[Dict[str, Any]], stream: bool = True) ->
             # Initialize an empty response string and a Streamlit placeholder for streaming output
             full_response = ""
             placeholder = st.empty()
+            # Render incrementally so each chunk only re-converts the block still being written
+            renderer = stream_renderer()
             # Iterate through the streamed chunks of responses
             for chunk in completion:
                 # Check if there is content to add to the full response
                 if chunk.choices[0].delta.content:
                     full_response += chunk.choices[0].delta.content
                     # Update the placeholder with the current full response
-                    placeholder.markdown(full_response)
+                    placeholder.markdown(renderer.feed(chunk.choices[0].delta.content), unsafe_allow_html=True)
+            placeholder.markdown(renderer.flush(), unsafe_allow_html=True)
             return full_response
         else:
             # Return the full response content when not streaming
@@ -254,7 +257,7 @@ if check_password():
     for message in st.session_state.full_conversation:
         avatar = "👩‍⚕️" if message["role"] == "user" else "🤓"
         with st.chat_message(message["role"], avatar=avatar):
-            st.markdown(message["content"])
+            st.markdown(render_markdown(message["content"]), unsafe_allow_html=True)
 
     # Accept user input and process it
     use_current_internet_info = st.checkbox("Use current internet information", help="If checked, the system will create a search query for Tavily and return results to help answer your question.")
@@ -276,7 +279,7 @@ if check_password():
             st.session_state.messages.append({"role": "user", "content": prompt})
         st.session_state.full_conversation.append({"role": "user", "content": prompt})
         with st.chat_message("user", avatar="👩‍⚕️"):
-            st.markdown(prompt)
+            st.markdown(render_markdown(prompt), unsafe_allow_html=True)
         with st.chat_message("assistant", avatar="🤓"):
             try:
                 st.session_state.messages = enforce_length_constraint_with_summarization(st.session_state.model, st.session_state.messages)
@@ -288,13 +291,11 @@ if check_password():
                 st.error(f"Error: {e}")
 
     # Offer download option for the conversation
+    # (rendered only on request, not on every rerun)
     if st.session_state.full_conversation:
-        conversation_str = "\n\n".join(
-            f"👩‍⚕️: {msg['content']}" if msg["role"] == "user" else f"🤓: {msg['content']}"
-            for msg in st.session_state.full_conversation
-        )
-        html = markdown2.markdown(conversation_str, extras=["tables"])
-        st.download_button('Download the conversation', html, f'conversation.html', 'text/html')
+        if st.button('Prepare the conversation for download'):
+            html = conversation_html(st.session_state.full_conversation, st.session_state.setdefault("conversation_export", {}))
+            st.download_button('Download the conversation', html, f'conversation.html', 'text/html')
 
     # Sidebar options to clear chat memory
     if st.sidebar.button("Clear chat memory (click twice to confirm)"):
@@ -304,6 +305,7 @@ if check_password():
     if st.sidebar.button("Clear recorded conversation and memory (click twice to confirm)"):
         st.session_state["messages"] = [{"role": "system", "content": system}]
         st.session_state["full_conversation"] = []
+        st.session_state["conversation_export"] = {}
         st.sidebar.info("Full history cleared and ready to start new conversation!")
 
     if st.session_state.summarized:
@@ -110,15 +110,18 @@ __version_info__ = (2, 4, 14)
 __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Trent Mick"
 
-import argparse
 import codecs
 import logging
 import re
 import sys
+import threading
 from collections import defaultdict, OrderedDict
 from abc import ABC, abstractmethod
+from bisect import bisect_right
 import functools
 from hashlib import sha256
+from os import urandom
+from time import perf_counter
 from random import randint, random
 from typing import Dict, List, Optional, Tuple, Union
 from enum import IntEnum, auto
@@ -156,34 +159,113 @@ class MarkdownError(Exception):
     pass
 
 
+class _DeadlineExceeded(MarkdownError):
+    """Raised within `Markdown.convert()` once its `deadline` has passed."""
+
+
 # ---- public api
 
 def markdown_path(path, encoding="utf-8",
                   html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
                   safe_mode=None, extras=None, link_patterns=None,
                   footnote_title=None, footnote_return_symbol=None,
-                  use_file_vars=False):
-    fp = codecs.open(path, 'r', encoding)
-    text = fp.read()
-    fp.close()
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
+                  use_file_vars=False, use_mmap=False):
+    """Convert the Markdown file at `path`. With `use_mmap`, the file is
+    decoded straight from a memory map of it rather than first being read
+    into memory, which saves a copy of its bytes for very large files.
+    """
+    if use_mmap:
+        text = _read_mapped(path, encoding)
+    else:
+        fp = codecs.open(path, 'r', encoding)
+        text = fp.read()
+        fp.close()
+    return markdown(text, html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
                     footnote_title=footnote_title,
                     footnote_return_symbol=footnote_return_symbol,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars)
+
+
+def _read_mapped(path, encoding):
+    import mmap
+    with open(path, 'rb') as fp:
+        try:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty, or not a regular file
+            return str(fp.read(), encoding)
+        with mapped:
+            return str(mapped, encoding)
 
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
              footnote_title=None, footnote_return_symbol=None,
-             use_file_vars=False, cli=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    footnote_title=footnote_title,
-                    footnote_return_symbol=footnote_return_symbol,
-                    use_file_vars=use_file_vars, cli=cli).convert(text)
+             use_file_vars=False, cli=False, profile=False, engine="regex",
+             hardened=False, deadline=None):
+    options = dict(html4tags=html4tags, tab_width=tab_width,
+                   safe_mode=safe_mode, extras=extras,
+                   link_patterns=link_patterns,
+                   footnote_title=footnote_title,
+                   footnote_return_symbol=footnote_return_symbol,
+                   use_file_vars=use_file_vars, cli=cli, profile=profile,
+                   engine=engine, hardened=hardened)
+    try:
+        key = (html4tags, tab_width, safe_mode, _freeze(extras),
+               _freeze(link_patterns), footnote_title,
+               footnote_return_symbol, use_file_vars, cli, profile, engine,
+               hardened)
+        hash(key)
+    except TypeError:
+        # unhashable option -- don't pool, just build a one-off converter
+        return Markdown(**options).convert(text, deadline=deadline)
+
+    # a cached result would carry the timings of an earlier conversion, and
+    # with `max_entries` 0 the cache is off: don't hash the text for it
+    cache_key = None
+    if not profile and render_cache.max_entries != 0:
+        cache_key = render_cache.key(text, key)
+    if cache_key is not None:
+        html = render_cache.lookup(cache_key)
+        if html is not None:
+            return html
+
+    md = _converter_pool.checkout(key, options)
+    try:
+        html = md.convert(text, deadline=deadline)
+    finally:
+        _converter_pool.checkin(key, md)
+    if cache_key is not None and not html.timed_out:
+        render_cache.store(cache_key, html)
+    return html
+
+
+def markdown_many(texts, workers=None, chunksize=None, **kwargs):
+    """Convert each of `texts` with the same `markdown()` options, returning
+    a list of the HTML in the same order.
+
+    The texts are spread over a pool of `workers` processes (default: one
+    per CPU), `chunksize` texts at a time. With `workers=1`, or fewer than
+    two texts, they are converted in this process.
+    """
+    texts = list(texts)
+    if workers is None:
+        from os import cpu_count
+        workers = cpu_count() or 1
+    workers = min(workers, len(texts))
+    if workers <= 1:
+        return [markdown(text, **kwargs) for text in texts]
+
+    if chunksize is None:
+        # a few chunks per worker, so that one long document doesn't leave
+        # the others idle at the end
+        chunksize = max(1, len(texts) // (workers * 4))
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(functools.partial(markdown, **kwargs), texts,
+                             chunksize=chunksize))
 
 
 class Stage(IntEnum):
@@ -216,36 +298,65 @@ def mark_stage(stage: Stage):
         @functools.wraps(func)
         def inner(md: 'Markdown', text, *args, **kwargs):
             md.stage = stage
+            if md._deadline is not None:
+                md._check_deadline()
+            if md._extra_plan_version != Extra._registry_version:
+                md._compile_extra_plan()
+
+            call = func if md._timings is None else md._timed(stage.name, func)
+            plan = md._extra_plan.get(stage)
+            if plan is None:
+                # no active extras hook into this stage
+                md.order = stage
+                text = call(md, text, *args, **kwargs)
+                md.order = stage + 0.5
+                return text
+
             # set "order" prop so extras can tell if they're being invoked before/after the stage
             md.order = stage - 0.5
-
-            if stage in Extra._exec_order:
-                for klass in Extra._exec_order[stage][0]:
-                    if klass.name not in md.extra_classes:
-                        continue
-                    extra = md.extra_classes[klass.name]
-                    if extra.test(text):
-                        text = extra.run(text)
+            for test, run in plan[0]:
+                if test(text):
+                    text = run(text)
 
             md.order = stage
-            text = func(md, text, *args, **kwargs)
+            text = call(md, text, *args, **kwargs)
             md.order = stage + 0.5
 
-            if stage in Extra._exec_order:
-                for klass in Extra._exec_order[stage][1]:
-                    if klass.name not in md.extra_classes:
-                        continue
-                    extra = md.extra_classes[klass.name]
-                    if extra.test(text):
-                        text = extra.run(text)
+            for test, run in plan[1]:
+                if test(text):
+                    text = run(text)
 
             return text
 
+        inner.stage = stage
         return inner
 
     return wrapper
 
 
+
+class _lazy_re(object):
+    """A class-level regex that is only compiled the first time it is used.
+
+    Most of these are only needed by some extras or options, so compiling
+    them all when the module is imported would mostly be wasted. On first
+    access the compiled pattern replaces this placeholder on the class, so
+    later lookups cost the same as they would for a plain attribute.
+    """
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __set_name__(self, owner, name):
+        self._owner = owner
+        self._name = name
+
+    def __get__(self, obj, objtype=None):
+        compiled = re.compile(self.pattern, self.flags)
+        setattr(self._owner, self._name, compiled)
+        return compiled
+
+
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
     # extra name to argument for the extra. Most extras do not have an
@@ -256,6 +367,21 @@ class Markdown(object):
     extras = None
     # dict of `Extra` names and associated class instances, populated during _setup_extras
     extra_classes = None
+    # per-stage `(before, after)` lists of bound `(test, run)` extra methods,
+    # compiled from `Extra._exec_order` by _compile_extra_plan
+    _extra_plan = None
+    _extra_plan_version = -1
+    # `{label: [calls, seconds]}` of the current conversion when profiling,
+    # see _timed
+    _timings = None
+    # `perf_counter()` value the current conversion must finish by, see convert
+    _deadline = None
+    # set while `parse()` runs, see _html_class_str_from_tag
+    _parsing = False
+    # set by _recycle, which leaves nothing for the next reset to do
+    _recycled = False
+    # the extras `extra_classes` was last built for, see _setup_extras
+    _extras_built = None
 
     urls = None
     titles = None
@@ -279,12 +405,15 @@ class Markdown(object):
     with `if md.order < md.stage`.
     '''
 
-    _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
+    _ws_only_line_re = _lazy_re(r"^[ \t]+$", re.M)
+    # The same, after a "\n" (which is much quicker to scan for)
+    _nl_ws_only_line_re = _lazy_re(r"\n[ \t]+(?=\n)")
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
                  extras=None, link_patterns=None,
                  footnote_title=None, footnote_return_symbol=None,
-                 use_file_vars=False, cli=False):
+                 use_file_vars=False, cli=False, profile=False, engine="regex",
+                 hardened=False):
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -347,24 +476,116 @@ class Markdown(object):
         self.footnote_title = footnote_title
         self.footnote_return_symbol = footnote_return_symbol
         self.use_file_vars = use_file_vars
-        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
         self.cli = cli
-
+        if profile:
+            self._timings = {}
+        if engine not in ("regex", "linear"):
+            raise MarkdownError("unknown block engine %r (expected 'regex' or 'linear')" % engine)
+        self.engine = engine
+        self.hardened = hardened
+
+        self._patterns = _patterns_for(tab_width, 0, self.safe_mode)
+        self._sub_list_patterns = _patterns_for(tab_width, 1, self.safe_mode)
+        self._outdent_re = self._patterns.outdent_re
+
+        self._init_placeholders()
+        self._init_tables()
+
+    def _init_placeholders(self):
+        # Placeholders are "md5-" + 24 hex digits of salt + an 8 hex digit
+        # counter. See `_hash_text()`.
+        self._placeholder_fmt = 'md5-' + urandom(12).hex() + '%08x'
+        self._placeholder_count = 0
+        self._placeholders = {}
+
+    def _init_tables(self):
         self._escape_table = g_escape_table.copy()
         self._code_table = {}
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            self._escape_table['"'] = self._hash_text('"')
+            self._escape_table["'"] = self._hash_text("'")
+
+    def _recycle(self):
+        """Drop the state a `convert()` leaves behind (placeholder tables,
+        header id counts, the last document's hashes, the extras' own
+        tables) so this instance renders its next text exactly as a freshly
+        constructed one would, without holding on to it. Used by the
+        converter pool; the next conversion's `reset()` then has nothing
+        left to do.
+
+            >>> m = Markdown(extras=['code-friendly'])
+            >>> html = m.convert("**a** __b__ [c](http://c.com) <http://d.com>")
+            >>> m._recycle()
+            >>> m._placeholders, m.extra_classes['code-friendly'].hash_table
+            ({}, {})
+            >>> m._escape_table == g_escape_table
+            True
+        """
+        if self._placeholder_count > 0xf0000000:
+            # re-salt before the counter outgrows its 8 hex digits
+            self._init_placeholders()
+        self.__dict__.pop('_count_from_header_id', None)
+        self._unhash_tbl = self._unhashed = None
+        self._recycled = False
+        self.reset()
+        self._recycled = True
 
     def reset(self):
+        r"""Clear the state of the last conversion.
+
+        Placeholders are only unique within a conversion, so the tables
+        mapping text to them start over too (see `_unhash_table()`). Reusing
+        an instance gives the same output as a fresh one, with one deliberate
+        exception: dict-form `header-ids` without `reset-count` keep counting
+        ids across conversions, so headers stay unique across documents
+        rendered onto one page.
+
+            >>> m = Markdown(extras=['toc'])
+            >>> text = "# A \\*\n\n# B [x](http://u.com/) `c`\n"
+            >>> first = m.convert(text)
+            >>> second = m.convert(text)
+            >>> second == first and second.toc_html == first.toc_html
+            True
+            >>> 'md5-' in second.toc_html
+            False
+            >>> m = Markdown(extras={'header-ids': {}})
+            >>> m.convert("# Hello\n") == m.convert("# Hello\n")
+            False
+        """
+        if self._recycled:
+            self._recycled = False
+            return
         self.urls = {}
         self.titles = {}
         self.html_blocks = {}
         self.html_spans = {}
+        self._placeholders = {}
+        self._unhash_state = None
         self.list_level = 0
+        if self._timings is not None:
+            self._timings = {}
         self.extras = self._instance_extras.copy()
         self._setup_extras()
+        self._init_tables()
         self._toc = None
+        self._toc_ids = set()
+        self._class_markers = {}
+
+    def _hash_text(self, s):
+        """Return the opaque placeholder that stands in for `s` until it is
+        swapped back in after conversion.
+
+        Placeholders have the same "md5-" + 32 hex digit shape as the module
+        level `_hash_text()`, but come from a salted per-instance counter
+        rather than hashing (and UTF-8 encoding) `s` each time. The same text
+        always gets the same placeholder within a conversion.
+        """
+        try:
+            return self._placeholders[s]
+        except KeyError:
+            self._placeholder_count += 1
+            key = self._placeholders[s] = self._placeholder_fmt % self._placeholder_count
+            return key
 
     def _setup_extras(self):
         if "footnotes" in self.extras:
@@ -378,11 +599,80 @@ class Markdown(object):
         if "metadata" in self.extras:
             self.metadata = {}
 
+        if (self._extras_built == self.extras
+                and self._extra_plan_version == Extra._registry_version):
+            # the same extras as last time: start their instances over
+            # rather than building new ones, and a new plan for them
+            for name, extra in self.extra_classes.items():
+                extra.__dict__.clear()
+                extra.__init__(self, self.extras.get(name, {}))
+            return
+        self._extras_built = dict(self.extras)
         self.extra_classes = {}
         for name, klass in Extra._registry.items():
             if name not in self.extras:
                 continue
             self.extra_classes[name] = klass(self, (self.extras.get(name, {})))
+        self._compile_extra_plan()
+
+    # `{frozenset(extra names): (registry version, {stage: (before, after)})}`
+    # -- the stage layout of the extra names, shared by all instances
+    _extra_plan_layouts = {}
+
+    def _compile_extra_plan(self):
+        """Flatten `Extra._exec_order` into the bound `(test, run)` pairs of
+        this instance's extras, for each stage that has any, so that
+        `mark_stage` doesn't walk the global registry on every call.
+        Recompiled when an extra is registered or deregistered.
+        """
+        names = frozenset(self.extra_classes)
+        version = Extra._registry_version
+        layout = self._extra_plan_layouts.get(names)
+        if layout is None or layout[0] != version:
+            stages = {}
+            for stage, exec_order in Extra._exec_order.items():
+                before, after = (
+                    [klass.name for klass in section if klass.name in names]
+                    for section in exec_order)
+                if before or after:
+                    stages[stage] = (before, after)
+            layout = self._extra_plan_layouts[names] = (version, stages)
+
+        # extras hooked into the stages of the block gamut, see _run_block_gamut_linear
+        self._block_stage_extras = set()
+        for stage in self._block_stages:
+            for section in layout[1].get(stage, ()):
+                self._block_stage_extras.update(section)
+
+        extras = self.extra_classes
+        if self._timings is None:
+            steps = {name: (extras[name].test, extras[name].run)
+                     for name in extras}
+        else:
+            steps = {}
+            for name, extra in extras.items():
+                label = extra.__class__.__name__
+                steps[name] = (self._timed(label + '.test', extra.test),
+                               self._timed(label + '.run', extra.run))
+        self._extra_plan = {
+            stage: ([steps[name] for name in before], [steps[name] for name in after])
+            for stage, (before, after) in layout[1].items()
+        }
+        self._extra_plan_version = version
+
+    def _timed(self, label, func):
+        """Wrap `func` so that its calls and wall time are added up under
+        `label` in `_timings`.
+        """
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                entry = self._timings.setdefault(label, [0, 0.0])
+                entry[0] += 1
+                entry[1] += perf_counter() - start
+        return timed
 
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
@@ -390,7 +680,7 @@ class Markdown(object):
     # Opens the linked document in a new window or tab
     # should only used in <a> tags with an "href" attribute.
     # same with _a_nofollow
-    _a_nofollow_or_blank_links = re.compile(r"""
+    _a_nofollow_or_blank_links = _lazy_re(r"""
         <(a)
         (
             [^>]*
@@ -402,8 +692,158 @@ class Markdown(object):
         re.IGNORECASE | re.VERBOSE
     )
 
-    def convert(self, text):
-        """Convert the given text."""
+    def convert(self, text, deadline=None):
+        """Convert the given text.
+
+        If `deadline` (in seconds) is given and the conversion is still
+        running after that long, it is abandoned and the text is returned
+        HTML-escaped in a `<pre>` block instead, with `timed_out` set on the
+        result. The same goes for input nested too deeply to convert when
+        `hardened` is set.
+        """
+        return self._guarded(self._convert, text, deadline)
+
+    def convert_to(self, text, writer, deadline=None):
+        """Convert the given text like `convert()`, but write the HTML to
+        `writer` (a file, a socket's file object, `io.StringIO` or anything
+        else with a `write()` method) instead of returning it.
+
+        Link references and footnotes can be defined anywhere in the text, so
+        the whole text is still converted before anything is written. But
+        the finished HTML is then written a few top-level blocks at a time
+        rather than assembled in one string, so a large document isn't held
+        in memory several times over. (The "toc" extra's `prepend` option
+        needs the whole document first and turns this off.)
+        """
+        text = self._guarded(self._convert_hashed, text, deadline)
+        if getattr(text, 'timed_out', False):
+            writer.write(text)
+            return
+        if "toc" in self.extras and self._toc and (
+                self.cli or (self.extras['toc'] is not None and self.extras['toc'].get('prepend', False))):
+            writer.write(self._finish(text))
+            return
+        for chunk in self._restored_chunks(text):
+            writer.write(chunk)
+        writer.write("\n")
+
+    def parse(self, text):
+        r"""Parse the given text into a `Document`, which `render()` turns
+        into the same HTML `convert()` returns, without parsing it again.
+
+        Only a few options take effect at render time: the "html-classes"
+        (every tag it can give a class gets the renderer's, whether or not
+        this instance has the extra), "target-blank-links" and "nofollow"
+        extras and the "toc" extra's `prepend`. All other options and
+        extras must match the ones the document was parsed with.
+
+        >>> doc = Markdown(extras=['tables']).parse('| a |\n|---|\n| b |\n')
+        >>> renderer = Markdown(extras={'tables': None, 'html-classes': {'table': 'two'}})
+        >>> renderer.render(doc) == renderer.convert('| a |\n|---|\n| b |\n')
+        True
+        >>> renderer.render(doc).startswith('<table class="two">')
+        True
+        """
+        self._parsing = True
+        try:
+            text = self._guarded(self._convert_hashed, text, None)
+        finally:
+            self._parsing = False
+        if getattr(text, 'timed_out', False):
+            # `_finish()` adds the trailing newline back
+            return Document([Block('pre', str(text)[:-1])], {})
+
+        blocks = []
+        for html in text.split('\n\n'):
+            match = self._block_tag_re.match(self.html_blocks.get(html.strip(), html))
+            blocks.append(Block(match.group(1).lower() if match else None, html))
+        return Document(blocks, dict(self._unhash_table()),
+                        spans=dict(self.html_spans),
+                        class_markers=dict(self._class_markers),
+                        toc=list(self._toc) if self._toc else None,
+                        metadata=self.metadata if "metadata" in self.extras else None,
+                        extras={name: arg for name, arg in self.extras.items()
+                                if self._instance_extras.get(name, arg) != arg
+                                or name not in self._instance_extras})
+
+    _block_tag_re = _lazy_re(r'\s*<(\w+)')
+
+    def render(self, doc):
+        """Render a `Document` from `parse()` as HTML. With the same options
+        and extras this is exactly what `convert()` returns for its text.
+        """
+        self._start_render(doc)
+        return self._finish('\n\n'.join(block.html for block in doc.blocks))
+
+    def render_text(self, doc):
+        """Render a `Document` from `parse()` as plain text, one paragraph
+        per top-level block (e.g. for a search index).
+        """
+        import html
+
+        self._start_render(doc)
+        paragraphs = []
+        for block in doc.blocks:
+            text = html.unescape(self._tag_re.sub('', self._restore_hashed(block.html)))
+            lines = [line.strip() for line in text.splitlines()]
+            text = '\n'.join(line for line in lines if line)
+            if text:
+                paragraphs.append(text)
+        return '\n\n'.join(paragraphs) + '\n'
+
+    _tag_re = _lazy_re(r'<[^>]*>')
+
+    def _start_render(self, doc):
+        self.reset()
+        if doc.extras:
+            self.extras.update(doc.extras)
+            self._setup_extras()
+        self.html_blocks = doc.hashes
+        self.html_spans = doc.spans
+        self._class_markers = doc.class_markers
+        self._toc = None
+        if doc.toc:
+            self._toc = [(level, id, self._fill_class_markers(name))
+                         for level, id, name in doc.toc]
+        if "metadata" in self.extras:
+            self.metadata = doc.metadata if doc.metadata is not None else {}
+
+    def _guarded(self, func, text, deadline):
+        """Call `func(text)`, returning `_timed_out_html(text)` instead if it
+        runs past `deadline` or (when hardened) recurses too deeply.
+        """
+        if deadline is None and not self.hardened:
+            return func(text)
+        if deadline is not None:
+            self._deadline = perf_counter() + deadline
+        try:
+            return func(text)
+        except _DeadlineExceeded:
+            return self._timed_out_html(text)
+        except RecursionError:
+            if not self.hardened:
+                raise
+            return self._timed_out_html(text)
+        finally:
+            self._deadline = None
+
+    def _check_deadline(self):
+        if self._deadline is not None and perf_counter() > self._deadline:
+            raise _DeadlineExceeded("conversion ran past its deadline")
+
+    def _timed_out_html(self, text):
+        if not isinstance(text, str):
+            text = str(text, 'utf-8')
+        for before, after in (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;')):
+            text = text.replace(before, after)
+        rv = UnicodeWithAttrs('<pre>%s</pre>\n' % text)
+        rv.timed_out = True
+        return rv
+
+    def _convert(self, text):
+        return self._finish(self._convert_hashed(text))
+
+    def _convert_hashed(self, text):
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
@@ -438,21 +878,7 @@ class Markdown(object):
 
             self._setup_extras()
 
-        # Standardize line endings:
-        text = text.replace("\r\n", "\n")
-        text = text.replace("\r", "\n")
-
-        # Make sure $text ends with a couple of newlines:
-        text += "\n\n"
-
-        # Convert all tabs to spaces.
-        text = self._detab(text)
-
-        # Strip any lines consisting only of spaces and tabs.
-        # This makes subsequent regexen easier to write, because we can
-        # match consecutive blank lines with /\n+/ instead of something
-        # contorted like /[ \t]*\n+/ .
-        text = self._ws_only_line_re.sub("", text)
+        text = self._normalize_whitespace(text)
 
         # strip metadata from head and extract
         if "metadata" in self.extras:
@@ -479,30 +905,27 @@ class Markdown(object):
         if "footnotes" in self.extras:
             text = self._add_footnotes(text)
 
-        text = self.postprocess(text)
-
-        text = self._unescape_special_chars(text)
-
-        if self.safe_mode:
-            text = self._unhash_html_spans(text)
-            # return the removed text warning to its markdown.py compatible form
-            text = text.replace(self.html_removed_text, self.html_removed_text_compat)
-
-        do_target_blank_links = "target-blank-links" in self.extras
-        do_nofollow_links = "nofollow" in self.extras
+        return self.postprocess(text)
 
-        if do_target_blank_links and do_nofollow_links:
-            text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="nofollow noopener" target="_blank"\2', text)
-        elif do_target_blank_links:
-            text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="noopener" target="_blank"\2', text)
-        elif do_nofollow_links:
-            text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="nofollow"\2', text)
+    def _finish(self, text):
+        """Turn the output of `_convert_hashed()` into the HTML `convert()`
+        returns.
+        """
+        text = self._add_link_rels(self._restore_hashed(text))
 
         if "toc" in self.extras and self._toc:
             if self.extras['header-ids'].get('mixed'):
                 # TOC will only be out of order if mixed headers is enabled
+                positions = {}
+                for match in self._toc_header_re.finditer(text):
+                    positions.setdefault((int(match.group(1)), match.group(3)), match.start())
+
                 def toc_sort(entry):
                     '''Sort the TOC by order of appearance in text'''
+                    try:
+                        return positions[entry[:2]]
+                    except KeyError:
+                        pass
                     return re.search(
                         # header tag, any attrs, the ID, any attrs, the text, close tag
                         r'^<(h%d).*?id=(["\'])%s\2.*>%s</\1>$' % (entry[0], entry[1], re.escape(entry[2])),
@@ -526,8 +949,65 @@ class Markdown(object):
 
         if "metadata" in self.extras:
             rv.metadata = self.metadata
+
+        if self._timings is not None:
+            rv.timings = {label: tuple(entry) for label, entry in self._timings.items()}
         return rv
 
+    def _restore_hashed(self, text):
+        # Swap the hashed special characters, code and HTML back in.
+        text = self._unescape_special_chars(text)
+
+        if self.safe_mode:
+            text = self._unhash_html_spans(text)
+            # return the removed text warning to its markdown.py compatible form
+            text = text.replace(self.html_removed_text, self.html_removed_text_compat)
+
+        if self._class_markers and not self._parsing:
+            text = self._fill_class_markers(text)
+        return text
+
+    def _fill_class_markers(self, text):
+        # Give the tags `parse()` marked for the "html-classes" extra their
+        # class (if any) from this instance's "html-classes".
+        for tag, key in self._class_markers.items():
+            text = text.replace(' class="%s"' % key, self._html_class_str_from_tag(tag))
+        return text
+
+    def _add_link_rels(self, text):
+        do_target_blank_links = "target-blank-links" in self.extras
+        do_nofollow_links = "nofollow" in self.extras
+
+        if do_target_blank_links and do_nofollow_links:
+            text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="nofollow noopener" target="_blank"\2', text)
+        elif do_target_blank_links:
+            text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="noopener" target="_blank"\2', text)
+        elif do_nofollow_links:
+            text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="nofollow"\2', text)
+        return text
+
+    def _restored_chunks(self, text, size=64 * 1024):
+        """Yield the HTML `_finish()` would make of `text` (bar the trailing
+        newline and TOC) in pieces of roughly `size` characters, split at
+        blank lines.
+        """
+        held = ''
+        pos = 0
+        while pos < len(text):
+            end = text.find('\n\n', pos + size)
+            end = len(text) if end == -1 else end + 2
+            chunk = held + self._restore_hashed(text[pos:end])
+            pos = end
+            if pos < len(text) and '<a' in chunk[chunk.rfind('>') + 1:].lower():
+                # an unfinished <a tag that `_add_link_rels` might change
+                held = chunk
+                continue
+            held = ''
+            yield self._add_link_rels(chunk)
+
+    # header tag, any attrs, the ID, any attrs, the text, close tag
+    _toc_header_re = _lazy_re(r'^<h([1-6]).*?id=(["\'])(.*?)\2.*>.*</h\1>$', re.M)
+
     @mark_stage(Stage.POSTPROCESS)
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
@@ -556,7 +1036,7 @@ class Markdown(object):
     #   another-var: blah blah
     #
     #   # header
-    _meta_data_pattern = re.compile(r'''
+    _meta_data_pattern = _lazy_re(r'''
         ^{0}(  # optional opening fence
             (?:
                 {1}:(?:\n+[ \t]+.*)+  # indented lists
@@ -570,19 +1050,22 @@ class Markdown(object):
         '''.format(r'(?:---[\ \t]*\n)?', r'[\S \t]*\w[\S \t]*\s*'), re.MULTILINE | re.VERBOSE
     )
 
-    _key_val_list_pat = re.compile(
+    _key_val_list_pat = _lazy_re(
         r"^-(?:[ \t]*([^\n]*)(?:[ \t]*[:-][ \t]*(\S+))?)(?:\n((?:[ \t]+[^\n]+\n?)+))?",
         re.MULTILINE,
     )
-    _key_val_dict_pat = re.compile(
+    _key_val_dict_pat = _lazy_re(
         r"^([^:\n]+)[ \t]*:[ \t]*([^\n]*)(?:((?:\n[ \t]+[^\n]+)+))?", re.MULTILINE
     )  # grp0: key, grp1: value, grp2: multiline value
-    _meta_data_fence_pattern = re.compile(r'^---[\ \t]*\n', re.MULTILINE)
-    _meta_data_newline = re.compile("^\n", re.MULTILINE)
+    _meta_data_fence_pattern = _lazy_re(r'^---[\ \t]*\n', re.MULTILINE)
+    _meta_data_newline = _lazy_re("^\n", re.MULTILINE)
 
     def _extract_metadata(self, text):
         if text.startswith("---"):
             fence_splits = re.split(self._meta_data_fence_pattern, text, maxsplit=2)
+            if len(fence_splits) < 3:
+                # no closing fence (yet, if the text is being streamed)
+                return text
             metadata_content = fence_splits[1]
             match = re.findall(self._meta_data_pattern, metadata_content)
             if not match:
@@ -594,7 +1077,7 @@ class Markdown(object):
             match = re.findall(self._meta_data_pattern, metadata_content)
             if not match:
                 return text
-            tail = metadata_split[1]
+            tail = metadata_split[1] if len(metadata_split) > 1 else ''
 
         def parse_structured_value(value):
             vs = value.lstrip()
@@ -651,7 +1134,7 @@ class Markdown(object):
 
         return tail
 
-    _emacs_oneliner_vars_pat = re.compile(r"((?:<!--)?\s*-\*-)\s*(?:(\S[^\r\n]*?)([\r\n]\s*)?)?(-\*-\s*(?:-->)?)", re.UNICODE)
+    _emacs_oneliner_vars_pat = _lazy_re(r"((?:<!--)?\s*-\*-)\s*(?:(\S[^\r\n]*?)([\r\n]\s*)?)?(-\*-\s*(?:-->)?)", re.UNICODE)
     # This regular expression is intended to match blocks like this:
     #    PREFIX Local Variables: SUFFIX
     #    PREFIX mode: Tcl SUFFIX
@@ -660,7 +1143,7 @@ class Markdown(object):
     # - "[ \t]" is used instead of "\s" to specifically exclude newlines
     # - "(\r\n|\n|\r)" is used instead of "$" because the sre engine does
     #   not like anything other than Unix-style line terminators.
-    _emacs_local_vars_pat = re.compile(r"""^
+    _emacs_local_vars_pat = _lazy_re(r"""^
         (?P<prefix>(?:[^\r\n|\n|\r])*?)
         [\ \t]*Local\ Variables:[\ \t]*
         (?P<suffix>.*?)(?:\r\n|\n|\r)
@@ -777,19 +1260,27 @@ class Markdown(object):
 
         return emacs_vars
 
-    def _detab_line(self, line):
-        r"""Recusively convert tabs to spaces in a single line.
+    def _normalize_whitespace(self, text):
+        r"""Standardize line endings, make sure `text` ends with a couple of
+        newlines, convert all tabs to spaces and strip any lines consisting
+        only of spaces and tabs.
 
-        Called from _detab()."""
-        if '\t' not in line:
-            return line
-        chunk1, chunk2 = line.split('\t', 1)
-        chunk1 += (' ' * (self.tab_width - len(chunk1) % self.tab_width))
-        output = chunk1 + chunk2
-        return self._detab_line(output)
+        The last makes subsequent regexen easier to write, because we can
+        match consecutive blank lines with /\n+/ instead of something
+        contorted like /[ \t]*\n+/ .
+        """
+        if '\r' in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        text = self._detab(text + "\n\n")
+        if ' \n' in text or '\t\n' in text:
+            text = self._nl_ws_only_line_re.sub("\n", "\n" + text)[1:]
+        return text
+
+    # Where `str.splitlines()` breaks lines, other than at "\n"
+    _line_boundary_re = _lazy_re(r'[\r\v\f\x1c-\x1e\x85\u2028\u2029]')
 
     def _detab(self, text):
-        r"""Iterate text line by line and convert tabs to spaces.
+        r"""Convert tabs to spaces, line by line.
 
             >>> m = Markdown()
             >>> m._detab("\tfoo")
@@ -805,10 +1296,11 @@ class Markdown(object):
         """
         if '\t' not in text:
             return text
-        output = []
-        for line in text.splitlines():
-            output.append(self._detab_line(line))
-        return '\n'.join(output)
+        if self._line_boundary_re.search(text):
+            return '\n'.join(line.expandtabs(self.tab_width) for line in text.splitlines())
+        # as if split into lines and joined back up
+        text = text.expandtabs(self.tab_width)
+        return text[:-1] if text.endswith('\n') else text
 
     # I broke out the html5 tags here and add them to _block_tags_a and
     # _block_tags_b.  This way html5 tags are easy to keep track of.
@@ -817,7 +1309,7 @@ class Markdown(object):
     _block_tags_a = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math|ins|del|style'
     _block_tags_a += _html5tags
 
-    _strict_tag_block_re = re.compile(r"""
+    _strict_tag_block_re = _lazy_re(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -833,7 +1325,7 @@ class Markdown(object):
     _block_tags_b = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math'
     _block_tags_b += _html5tags
 
-    _liberal_tag_block_re = re.compile(r"""
+    _liberal_tag_block_re = _lazy_re(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -846,7 +1338,7 @@ class Markdown(object):
         """ % _block_tags_b,
         re.X | re.M)
 
-    _html_markdown_attr_re = re.compile(
+    _html_markdown_attr_re = _lazy_re(
         r'''\s+markdown=("1"|'1')''')
     def _hash_html_block_sub(self, match, raw=False):
         if isinstance(match, str):
@@ -879,16 +1371,16 @@ class Markdown(object):
                 # remove `markdown="1"` attr from tag
                 first_line = first_line[:m.start()] + first_line[m.end():]
                 # hash the HTML segments to protect them
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
         elif self.extras.get('header-ids', {}).get('mixed') and self._h_tag_re.match(html):
             html = self._h_tag_re.sub(self._h_tag_sub, html)
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -925,21 +1417,29 @@ class Markdown(object):
         text = self._strict_tag_block_sub(text, self._block_tags_a, hash_html_block_sub)
 
         # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
-        text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
+        if self.hardened:
+            text = self._liberal_tag_block_sub(text, hash_html_block_sub)
+        else:
+            text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
 
         # Special case just for <hr />. It was easier to make a special
         # case than to make the other regex more complicated.
         if "<hr" in text:
-            _hr_tag_re = _hr_tag_re_from_tab_width(self.tab_width)
-            text = _hr_tag_re.sub(hash_html_block_sub, text)
+            text = self._patterns.hr_tag_re.sub(hash_html_block_sub, text)
 
         # Special case for standalone HTML comments:
         if "<!--" in text:
+            edits = []
+            # `start` is where the next search resumes, as an offset into
+            # the text with the edits so far applied (which is `shift`
+            # longer); never before the end of the last edit.
             start = 0
+            shift = 0
+            floor = 0
             while True:
                 # Delimiters for next comment block.
                 try:
-                    start_idx = text.index("<!--", start)
+                    start_idx = text.index("<!--", max(start - shift, floor))
                 except ValueError:
                     break
                 try:
@@ -948,7 +1448,7 @@ class Markdown(object):
                     break
 
                 # Start position for next comment block search.
-                start = end_idx
+                start = end_idx + shift
 
                 # Validate whitespace before comment.
                 if start_idx:
@@ -984,9 +1484,13 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
-                text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
+                replacement = "\n\n" + key + "\n\n"
+                edits.append((start_idx, end_idx, replacement))
+                shift += len(replacement) - (end_idx - start_idx)
+                floor = end_idx
+            text = _apply_edits(text, edits)
 
         if "xml" in self.extras:
             # Treat XML processing instructions and namespaced one-liner
@@ -996,8 +1500,7 @@ class Markdown(object):
             #    <?foo bar?>
             #
             #    <xi:include xmlns:xi="http://www.w3.org/2001/XInclude" href="chapter_1.md"/>
-            _xml_oneliner_re = _xml_oneliner_re_from_tab_width(self.tab_width)
-            text = _xml_oneliner_re.sub(hash_html_block_sub, text)
+            text = self._patterns.xml_oneliner_re.sub(hash_html_block_sub, text)
 
         return text
 
@@ -1050,33 +1553,37 @@ class Markdown(object):
         # super basic check if number of open tags == number of closing tags
         return len(re.findall('<%s(?:.*?)>' % tag_name, text)) == len(re.findall('</%s>' % tag_name, text))
 
+    _liberal_tag_block_start_re = _lazy_re(r'^<(%s)\b' % _block_tags_b, re.M)
+    _liberal_tag_block_end_re = _lazy_re(r'</(%s)>[ \t]*$' % _block_tags_b, re.M)
+
+    def _liberal_tag_block_sub(self, text, callback):
+        """`self._liberal_tag_block_re.sub(callback, text)`, for hardened mode.
+
+        The regex is only tried at start tags with a matching end tag at the
+        end of some line after them, rather than letting each unclosed start
+        tag rescan the rest of the text.
+        """
+        last_end = {}
+        for match in self._liberal_tag_block_end_re.finditer(text):
+            last_end[match.group(1)] = match.start()
+        result = []
+        pos = 0
+        for match in self._liberal_tag_block_start_re.finditer(text):
+            if match.start() < pos or last_end.get(match.group(1), -1) < match.end():
+                continue
+            match = self._liberal_tag_block_re.match(text, match.start())
+            if match:
+                result.append(text[pos:match.start()])
+                result.append(callback(match))
+                pos = match.end()
+        result.append(text[pos:])
+        return ''.join(result)
+
     @mark_stage(Stage.LINK_DEFS)
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
-        # Link defs are in the form:
-        #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
-        return _link_def_re.sub(self._extract_link_def_sub, text)
+        return self._patterns.link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
         id, url, title = match.groups()
@@ -1110,31 +1617,20 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
-        return footnote_def_re.sub(self._extract_footnote_def_sub, text)
+        return self._patterns.footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
-    _hr_re = re.compile(r'^[ ]{0,3}([-_*])[ ]{0,2}(\1[ ]{0,2}){2,}$', re.M)
+    _hr_re = _lazy_re(r'^[ ]{0,3}([-_*])[ ]{0,2}(\1[ ]{0,2}){2,}$', re.M)
 
     @mark_stage(Stage.BLOCK_GAMUT)
     def _run_block_gamut(self, text):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
 
+        if self.engine == "linear":
+            blocks = self._split_blocks(text)
+            if blocks is not None:
+                return self._run_block_gamut_linear(blocks)
+
         text = self._do_headers(text)
 
         # Do Horizontal Rules:
@@ -1161,6 +1657,105 @@ class Markdown(object):
 
         return text
 
+    # The stages of the block gamut, in order. Extras hooked into them must be
+    # in `_linear_block_extras` for the linear engine to be used.
+    _block_stages = (Stage.HEADERS, Stage.LISTS, Stage.CODE_BLOCKS,
+                     Stage.BLOCK_QUOTES, Stage.HASH_HTML, Stage.PARAGRAPHS)
+    # Extras that only ever match runs of non-blank lines within one block
+    _linear_block_extras = frozenset(('tables', 'wiki-tables'))
+
+    # Top-level block boundary: blank lines, then a line starting at the left
+    # margin that can't continue a list, code block or block quote above it.
+    _block_boundary_re = _lazy_re(r'\n{2,}(?=\S)(?!>|(?:[*+-]|\d+\.)[ \t])')
+    # Input the regex engine may treat across block boundaries: raw HTML at
+    # the start of a line, HTML comments, and `</code>` (see _do_code_blocks).
+    _linear_unsafe_re = _lazy_re(r'^[ ]{0,3}<|<!--|</code>', re.M)
+
+    def _split_blocks(self, text):
+        r"""Split the block gamut's input into top-level blocks, or return None
+        if the linear engine can't be used on it.
+
+        No construct the regex engine matches (list, code block, block quote,
+        table, ...) runs past a block boundary, so running each stage over
+        the blocks one after another gives the same result as running it over
+        the whole text, with each stage's scans confined to a single block.
+        That has to hold for every extra in `_linear_block_extras` too:
+
+        >>> text = ("| a | b |\n|---|---|\n| 1 | 2 |\n\n|| x || y ||\n"
+        ...         "|| 1 || 2 ||\n\n> q3\n>>> print(1)\n1\n\nText after\n\n"
+        ...         "    code\n\n* item\n\n1. one\n")
+        >>> all(markdown(text, extras=[extra]) == markdown(text, extras=[extra], engine="linear")
+        ...     for extra in Markdown._linear_block_extras)
+        True
+        """
+        if self.list_level or not self._block_stage_extras <= self._linear_block_extras:
+            # (sub-lists and code blocks are output without the blank lines
+            # that followed them, so they join onto the next block)
+            return None
+        if self._linear_unsafe_re.search(text):
+            return None
+        blocks = []
+        start = 0
+        for match in self._block_boundary_re.finditer(text):
+            if match.start() == start:
+                continue  # leading blank lines aren't a block
+            last_line = text[text.rfind('\n', start, match.start()) + 1:match.start()]
+            if last_line.startswith(('\t', self.tab)):
+                continue  # may end a code block
+            blocks.append(text[start:match.end()])
+            start = match.end()
+        if not blocks:
+            return None
+        blocks.append(text[start:])
+        return blocks
+
+    def _run_block_gamut_linear(self, blocks):
+        """The block gamut of `_run_block_gamut`, run stage by stage over the
+        top-level blocks from `_split_blocks`.
+        """
+        blocks = self._run_stage_over_blocks(self._do_headers, blocks)
+
+        hr = "\n<hr"+self.empty_element_suffix+"\n"
+        blocks = [self._hr_re.sub(hr, block) for block in blocks]
+
+        blocks = self._run_stage_over_blocks(self._do_lists, blocks)
+        blocks = self._run_stage_over_blocks(self._do_code_blocks, blocks)
+        blocks = self._run_stage_over_blocks(self._do_block_quotes, blocks)
+        blocks = self._run_stage_over_blocks(self._hash_html_blocks, blocks)
+        blocks = self._run_stage_over_blocks(self._form_paragraphs, blocks)
+        return "\n\n".join(blocks)
+
+    def _run_stage_over_blocks(self, method, blocks):
+        """Run the `mark_stage` decorated `method` over each of `blocks` as a
+        single stage: each extra hooked into it runs over every block in turn,
+        in the same order it would have run over the whole text.
+        """
+        stage = getattr(method, 'stage', None)
+        if stage is None:
+            # overridden without `mark_stage`
+            return [method(block) for block in blocks]
+        func = method.__wrapped__
+        if self._timings is not None:
+            func = self._timed(stage.name, func)
+        before, after = self._extra_plan.get(stage, ((), ()))
+
+        self.stage = stage
+        self.order = stage - 0.5
+        for test, run in before:
+            blocks = [run(block) if test(block) else block for block in blocks]
+
+        results = []
+        for block in blocks:
+            self.order = stage
+            results.append(func(self, block))
+
+        self.order = stage + 0.5
+        for test, run in after:
+            results = [run(block) if test(block) else block for block in results]
+        return results
+
+    _hard_break_re = _lazy_re(r" {2,}\n(?!\<(?:\/?(ul|ol|li))\>)")
+
     @mark_stage(Stage.SPAN_GAMUT)
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
@@ -1183,12 +1778,13 @@ class Markdown(object):
         text = self._do_italics_and_bold(text)
 
         # Do hard breaks
-        text = re.sub(r" {2,}\n(?!\<(?:\/?(ul|ol|li))\>)", "<br%s\n" % self.empty_element_suffix, text)
+        if '  \n' in text:
+            text = self._hard_break_re.sub("<br%s\n" % self.empty_element_suffix, text)
 
         return text
 
     # "Sorta" because auto-links are identified as "tag" tokens.
-    _sorta_html_tokenize_re = re.compile(r"""
+    _sorta_html_tokenize_re = _lazy_re(r"""
         (
             \\*  # escapes
             (?:
@@ -1207,6 +1803,14 @@ class Markdown(object):
             )
         )
         """, re.X)
+    # A quoted attribute value can't run on past its closing quote (which makes
+    # an unclosed tag with many attributes backtrack exponentially).
+    _sorta_html_tokenize_re_hardened = _lazy_re(
+        _sorta_html_tokenize_re.pattern.replace(
+            r'''(?:".*?"|'.*?')''', r'''(?:"[^"\n]*"|'[^'\n]*')'''),
+        re.X)
+
+    _lead_escape_re = _lazy_re(r'^((?:\\\\)*(?!\\))')
 
     @mark_stage(Stage.ESCAPE_SPECIAL)
     def _escape_special_chars(self, text):
@@ -1216,10 +1820,14 @@ class Markdown(object):
         # it isn't susceptible to unmatched '<' and '>' in HTML tags).
         # Note, however, that '>' is not allowed in an auto-link URL
         # here.
-        lead_escape_re = re.compile(r'^((?:\\\\)*(?!\\))')
+        if '<' not in text and '\\' not in text:
+            return text  # no markup to tokenize, nothing escaped
+        lead_escape_re = self._lead_escape_re
         escaped = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        tokenize_re = (self._sorta_html_tokenize_re_hardened if self.hardened
+                       else self._sorta_html_tokenize_re)
+        for token in tokenize_re.split(text):
             # check token is preceded by 0 or more PAIRS of escapes, because escape pairs
             # escape themselves and don't affect the token
             if is_html_markup and lead_escape_re.match(token):
@@ -1251,32 +1859,40 @@ class Markdown(object):
                 return True
             return False
 
+        # a code span hashed by `_do_code_spans` tokenizes as its `<code>`
+        # tag (with any "html-classes" class), its placeholder and `</code>`
+        code_tag = '<code%s>' % self._span_class_str_from_tag('code')
+
         def _is_code_span(index, token):
-            try:
-                if token == '<code>':
-                    peek_tokens = split_tokens[index: index + 3]
-                elif token == '</code>':
-                    peek_tokens = split_tokens[index - 2: index + 1]
-                else:
-                    return False
-            except IndexError:
+            if token == code_tag:
+                start = index
+            elif token == '</code>':
+                start = index - 2
+            else:
                 return False
-
-            return re.match(r'<code>md5-[A-Fa-f0-9]{32}</code>', ''.join(peek_tokens))
+            return (start >= 0 and start + 2 < len(split_tokens)
+                    and split_tokens[start].startswith(code_tag)
+                    and split_tokens[start + 2].startswith('</code>')
+                    and placeholder_token_re.fullmatch(split_tokens[start + 1]) is not None)
 
         def _is_comment(token):
             if self.safe_mode == 'replace':
                 # don't bother processing each section of comment in replace mode. Just do the whole thing
                 return
-            return re.match(r'(<!--)(.*)(-->)', token)
+            if not token.startswith('<!--'):
+                return
+            return self._patterns.comment_token_re.match(token)
 
         def _hash(token):
-            key = _hash_text(token)
+            key = self._hash_text(token)
             self.html_spans[key] = token
             return key
 
         tokens = []
-        split_tokens = self._sorta_html_tokenize_re.split(text)
+        placeholder_token_re = self._patterns.placeholder_token_re
+        tokenize_re = (self._sorta_html_tokenize_re_hardened if self.hardened
+                       else self._sorta_html_tokenize_re)
+        split_tokens = tokenize_re.split(text)
         is_html_markup = False
         for index, token in enumerate(split_tokens):
             if is_html_markup and not _is_auto_link(token) and not _is_code_span(index, token):
@@ -1294,27 +1910,26 @@ class Markdown(object):
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        spans = self.html_spans
+        if not spans or 'md5-' not in text:
+            return text
+
+        def unhash_sub(match):
+            key = match.group()
+            return spans.get(key, key)
+
+        return self._hash_re.sub(unhash_sub, text)
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
             return self.html_removed_text
         elif self.safe_mode == "escape":
-            replacements = [
-                ('&', '&amp;'),
-                ('<', '&lt;'),
-                ('>', '&gt;'),
-            ]
-            for before, after in replacements:
-                s = s.replace(before, after)
-            return s
+            return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
         else:
             raise MarkdownError("invalid value for 'safe_mode': %r (must be "
                                 "'escape' or 'replace')" % self.safe_mode)
 
-    _inline_link_title = re.compile(r'''
+    _inline_link_title = _lazy_re(r'''
             (                   # \1
               [ \t]+
               (['"])            # quote char = \2
@@ -1323,7 +1938,7 @@ class Markdown(object):
             )?                  # title is optional
           \)$
         ''', re.X | re.S)
-    _tail_of_reference_link_re = re.compile(r'''
+    _tail_of_reference_link_re = _lazy_re(r'''
           # Match tail of: [text][id]
           [ ]?          # one optional space
           (?:\n[ ]*)?   # one optional newline followed by spaces
@@ -1332,9 +1947,9 @@ class Markdown(object):
           \]
         ''', re.X | re.S)
 
-    _whitespace = re.compile(r'\s*')
+    _whitespace = _lazy_re(r'\s*')
 
-    _strip_anglebrackets = re.compile(r'<(.*)>.*')
+    _strip_anglebrackets = _lazy_re(r'<(.*)>.*')
 
     def _find_non_whitespace(self, text, start):
         """Returns the index of the first non-whitespace character in text
@@ -1380,7 +1995,7 @@ class Markdown(object):
 
     # https://developer.mozilla.org/en-US/docs/web/http/basics_of_http/data_urls
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Basics_of_HTTP/MIME_types
-    _data_url_re = re.compile(r'''
+    _data_url_re = _lazy_re(r'''
         data:
         # in format type/subtype;parameter=optional
         (?P<mime>\w+/[\w+\.-]+(?:;\w+=[\w+\.-]+)?)?
@@ -1402,7 +2017,7 @@ class Markdown(object):
             if mime.startswith('image/') and data_url.group('token') == ';base64':
                 charset='base64'
         url = _html_escape_url(url, safe_mode=self.safe_mode, charset=charset)
-        key = _hash_text(url)
+        key = self._hash_text(url)
         self._escape_table[url] = key
         return key
 
@@ -1417,14 +2032,7 @@ class Markdown(object):
         Modifications and bugfixes (c) 2009 Dana Robinson
         Modifications and bugfixes (c) 2009-2014 Stack Exchange Inc.
         '''
-        safe = r'-\w'
-        # omitted ['"<>] for XSS reasons
-        less_safe = r'#/\.!#$%&\(\)\+,/:;=\?@\[\]^`\{\}\|~'
-        # dot seperated hostname, optional port number, not followed by protocol seperator
-        domain = r'(?:[%s]+(?:\.[%s]+)*)(?:(?<!tel):\d+/?)?(?![^:/]*:/*)' % (safe, safe)
-        fragment = r'[%s]*' % (safe + less_safe)
-
-        return re.compile(r'^(?:(%s)?(%s)(%s)|(#|\.{,2}/)(%s))$' % (self._safe_protocols, domain, fragment, fragment), re.I)
+        return _safe_href_re_from_protocols(self._safe_protocols)
 
     @mark_stage(Stage.LINKS)
     def _do_links(self, text):
@@ -1464,6 +2072,7 @@ class Markdown(object):
                 start_idx = text.index('[', curr_pos)
             except ValueError:
                 break
+            self._check_deadline()
             text_length = len(text)
 
             # Find the matching closing ']'.
@@ -1472,8 +2081,12 @@ class Markdown(object):
             # matching brackets in img alt text -- we'll differ in that
             # regard.
             bracket_depth = 0
-            for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL,
-                                            text_length)):
+            search_end = min(start_idx+MAX_LINK_TEXT_SENTINEL, text_length)
+            if text.find(']', start_idx+1, search_end) == -1:
+                # No closing bracket at all within sentinel length.
+                curr_pos = start_idx + 1
+                continue
+            for p in range(start_idx+1, search_end):
                 ch = text[p]
                 if ch == ']':
                     bracket_depth -= 1
@@ -1656,7 +2269,7 @@ class Markdown(object):
         prefix = self.extras['header-ids'].get('prefix')
         if prefix and isinstance(prefix, str):
             header_id = prefix + '-' + header_id
-        return header_id in self._count_from_header_id or header_id in map(lambda x: x[1], self._toc)
+        return header_id in self._count_from_header_id or header_id in self._toc_ids
 
     def _toc_add_entry(self, level, id, name):
         if level > self._toc_depth:
@@ -1664,6 +2277,7 @@ class Markdown(object):
         if self._toc is None:
             self._toc = []
         self._toc.append((level, id, self._unescape_special_chars(name)))
+        self._toc_ids.add(id)
 
     _h_re_base = r'''
         (^(.+)[ \t]{0,99}\n(=+|-+)[ \t]*\n+)
@@ -1678,8 +2292,8 @@ class Markdown(object):
         )
         '''
 
-    _h_re = re.compile(_h_re_base % '*', re.X | re.M)
-    _h_re_tag_friendly = re.compile(_h_re_base % '+', re.X | re.M)
+    _h_re = _lazy_re(_h_re_base % '*', re.X | re.M)
+    _h_re_tag_friendly = _lazy_re(_h_re_base % '+', re.X | re.M)
 
     def _h_sub(self, match):
         '''Handles processing markdown headers'''
@@ -1708,7 +2322,7 @@ class Markdown(object):
             self._toc_add_entry(n, header_id, html)
         return "<h%d%s>%s</h%d>\n\n" % (n, header_id_attr, html, n)
 
-    _h_tag_re = re.compile(r'''
+    _h_tag_re = _lazy_re(r'''
         ^<h([1-6])(.*)>  # \1 tag num, \2 attrs
         (.*)  # \3 text
         </h\1>
@@ -1775,6 +2389,9 @@ class Markdown(object):
             lst_opts = ''
 
         lst_opts = lst_opts + self._html_class_str_from_tag(lst_type)
+        if "smarty-pants" in self.extras:
+            # a sub-list goes through the span gamut with its item
+            lst_opts = lst_opts.replace('"', self._escape_table['"'])
 
         result = self._process_list_items(lst)
         if self.list_level:
@@ -1786,48 +2403,17 @@ class Markdown(object):
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
+        patterns = self._sub_list_patterns if self.list_level else self._patterns
+
         # Iterate over each *non-overlapping* list match.
         pos = 0
         while True:
+            self._check_deadline()
             # Find the *first* hit for either list style (ul or ol). We
             # match ul and ol separately to avoid adjacent lists of different
             # types running into each other (see issue #16).
             hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                other_marker_pat = self._marker_ul if marker_pat == self._marker_ol else self._marker_ol
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        ([ ]{0,%d})     # \3 = the indentation level of the list item marker
-                        (%s)            # \4 = first list item marker
-                        [ \t]+
-                        (?!\ *\4\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \5
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                        |
-                          \n+
-                          (?=
-                            \3          # lookahead for a different style of list item marker
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat, other_marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
+            for list_re in (patterns.ul_list_re, patterns.ol_list_re):
                 match = list_re.search(text, pos)
                 if match:
                     hits.append((match.start(), match))
@@ -1842,7 +2428,7 @@ class Markdown(object):
 
         return text
 
-    _list_item_re = re.compile(r'''
+    _list_item_re = _lazy_re(r'''
         (\n)?                   # leading line = \1
         (^[ \t]*)               # leading whitespace = \2
         (?P<marker>%s) [ \t]+   # list marker = \3
@@ -1852,7 +2438,7 @@ class Markdown(object):
         ''' % (_marker_any, _marker_any),
         re.M | re.X | re.S)
 
-    _task_list_item_re = re.compile(r'''
+    _task_list_item_re = _lazy_re(r'''
         (\[[\ xX]\])[ \t]+       # tasklist marker = \1
         (.*)                   # list item text = \2
     ''', re.M | re.X | re.S)
@@ -1919,47 +2505,26 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _pygments_lexer_from_name(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
         import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def _add_newline(self, inner):
-                # Add newlines around the inner contents so that _strict_tag_block_re matches the outer div.
-                yield 0, "\n"
-                yield from inner
-                yield 0, "\n"
-
-            def wrap(self, source, outfile=None):
-                """Return the source with a code, pre, and div."""
-                if outfile is None:
-                    # pygments >= 2.12
-                    return self._add_newline(self._wrap_pre(self._wrap_code(source)))
-                else:
-                    # pygments < 2.12
-                    return self._wrap_div(self._add_newline(self._wrap_pre(self._wrap_code(source))))
 
         formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        try:
+            key = (type(lexer), _freeze(lexer.options), _freeze(formatter_opts),
+                   sha256(codeblock.encode('utf-8')).digest())
+            hash(key)
+        except TypeError:
+            # unhashable formatter option -- don't memoize this one
+            key = None
+        colored = None if key is None else _highlight_cache.get(key)
+        if colored is None:
+            formatter = _html_code_formatter_class()(**formatter_opts)
+            colored = pygments.highlight(codeblock, lexer, formatter)
+            if key is not None:
+                _highlight_cache.put(key, colored, len(colored))
+        return colored
 
     def _code_block_sub(self, match):
         codeblock = match.group(1)
@@ -1980,6 +2545,13 @@ class Markdown(object):
         """Get the appropriate ' class="..."' string (note the leading
         space), if any, for the given tag.
         """
+        if self._parsing:
+            # `render()` puts the renderer's class (if any) in its place,
+            # whatever "html-classes" this instance has
+            if tag not in self._class_markers:
+                self._placeholder_count += 1
+                self._class_markers[tag] = self._placeholder_fmt % self._placeholder_count
+            return ' class="%s"' % self._class_markers[tag]
         if "html-classes" not in self.extras:
             return ""
         try:
@@ -1992,24 +2564,19 @@ class Markdown(object):
                     return ' class="%s"' % html_classes_from_tag[tag]
         return ""
 
+    def _span_class_str_from_tag(self, tag):
+        """`_html_class_str_from_tag()` for a tag the rest of the span
+        gamut still runs over: its quotes are escaped from smarty-pants.
+        """
+        class_str = self._html_class_str_from_tag(tag)
+        if "smarty-pants" in self.extras:
+            class_str = class_str.replace('"', self._escape_table['"'])
+        return class_str
+
     @mark_stage(Stage.CODE_BLOCKS)
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            # Lookahead to make sure this block isn't already in a code block.
-            # Needed when syntax highlighting is being used.
-            (?!([^<]|<(/?)span)*\</code\>)
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
-        return code_block_re.sub(self._code_block_sub, text)
+        return self._patterns.code_block_re.sub(self._code_block_sub, text)
 
     # Rules for a code span:
     # - backslash escapes are not interpreted in a code span
@@ -2019,7 +2586,7 @@ class Markdown(object):
     #   space and that space will be removed in the emitted HTML
     # See `test/tm-cases/escapes.text` for a number of edge-case
     # examples.
-    _code_span_re = re.compile(r'''
+    _code_span_re = _lazy_re(r'''
             (?<!\\)
             (`+)        # \1 = Opening run of `
             (?!`)       # See Note A test/tm-cases/escapes.text
@@ -2032,7 +2599,7 @@ class Markdown(object):
     def _code_span_sub(self, match):
         c = match.group(2).strip(" \t")
         c = self._encode_code(c)
-        return "<code%s>%s</code>" % (self._html_class_str_from_tag("code"), c)
+        return "<code%s>%s</code>" % (self._span_class_str_from_tag("code"), c)
 
     @mark_stage(Stage.CODE_SPANS)
     def _do_code_spans(self, text):
@@ -2058,6 +2625,8 @@ class Markdown(object):
         #       Turns to:
         #
         #         ... type <code>`bar`</code> ...
+        if '`' not in text:
+            return text
         return self._code_span_re.sub(self._code_span_sub, text)
 
     def _encode_code(self, text):
@@ -2075,20 +2644,61 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
+        hashed = self._hash_text(text)
         self._code_table[text] = hashed
         return hashed
 
-    _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]?)(?<=\S)\1", re.S)
-    _em_re = re.compile(r"(\*|_)(?=\S)(.*?\S)\1", re.S)
+    _strong_re = _lazy_re(r"(\*\*|__)(?=\S)(.+?[*_]?)(?<=\S)\1", re.S)
+    _em_re = _lazy_re(r"(\*|_)(?=\S)(.*?\S)\1", re.S)
 
     @mark_stage(Stage.ITALIC_AND_BOLD)
     def _do_italics_and_bold(self, text):
+        if '*' not in text and '_' not in text:
+            return text
+        if self.hardened:
+            text = self._delimited_sub(self._strong_re, r"<strong>\2</strong>", text, ('**', '__'))
+            return self._delimited_sub(self._em_re, r"<em>\2</em>", text, ('*', '_'))
         # <strong> must go first:
         text = self._strong_re.sub(r"<strong>\2</strong>", text)
         text = self._em_re.sub(r"<em>\2</em>", text)
         return text
 
+    def _delimited_sub(self, pattern, repl, text, delims):
+        """`pattern.sub(repl, text)` for hardened mode, where `pattern` is
+        one of `delims` and some text that ends in non-space, followed by the
+        same delimiter (like `_strong_re` and `_em_re`).
+
+        The regex is only tried at delimiters with a possible closing one
+        after them, rather than letting each unclosed delimiter rescan the
+        rest of the text.
+        """
+        width = len(delims[0])
+        starts = []
+        last_close = {}
+        for delim in delims:
+            last_close[delim] = -1
+            i = text.find(delim)
+            while i != -1:
+                starts.append(i)
+                if i and not text[i - 1].isspace():
+                    last_close[delim] = i
+                i = text.find(delim, i + 1)
+        starts.sort()
+
+        result = []
+        pos = 0
+        for start in starts:
+            # the closing delimiter follows at least one character of text
+            if start < pos or last_close[text[start:start + width]] <= start + width:
+                continue
+            match = pattern.match(text, start)
+            if match:
+                result.append(text[pos:start])
+                result.append(match.expand(repl))
+                pos = match.end()
+        result.append(text[pos:])
+        return ''.join(result)
+
     _block_quote_base = r'''
         (                           # Wrap whole match in \1
           (
@@ -2098,12 +2708,13 @@ class Markdown(object):
           )+
         )
     '''
-    _block_quote_re = re.compile(_block_quote_base % '', re.M | re.X)
-    _block_quote_re_spoiler = re.compile(_block_quote_base % '[ \t]*?!?', re.M | re.X)
-    _bq_one_level_re = re.compile('^[ \t]*>[ \t]?', re.M)
-    _bq_one_level_re_spoiler = re.compile('^[ \t]*>[ \t]*?![ \t]?', re.M)
-    _bq_all_lines_spoilers = re.compile(r'\A(?:^[ \t]*>[ \t]*?!.*[\n\r]*)+\Z', re.M)
-    _html_pre_block_re = re.compile(r'(\s*<pre>.+?</pre>)', re.S)
+    _block_quote_re = _lazy_re(_block_quote_base % '', re.M | re.X)
+    _block_quote_re_spoiler = _lazy_re(_block_quote_base % '[ \t]*?!?', re.M | re.X)
+    _bq_one_level_re = _lazy_re('^[ \t]*>[ \t]?', re.M)
+    _bq_one_level_re_spoiler = _lazy_re('^[ \t]*>[ \t]*?![ \t]?', re.M)
+    _bq_all_lines_spoilers = _lazy_re(r'\A(?:^[ \t]*>[ \t]*?!.*[\n\r]*)+\Z', re.M)
+    # (with or without the class "html-classes" gives it)
+    _html_pre_block_re = _lazy_re(r'(\s*<pre(?: class="[^"]*")?>.+?</pre>)', re.S)
     def _dedent_two_spaces_sub(self, match):
         return re.sub(r'(?m)^  ', '', match.group(1))
 
@@ -2228,48 +2839,59 @@ class Markdown(object):
         else:
             return text
 
-    _naked_lt_re = re.compile(r'<(?![a-z/?\$!])', re.I)
-    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"-])>''', re.I)
+    _naked_lt_re = _lazy_re(r'<(?![a-z/?\$!])', re.I)
+    _naked_gt_re = _lazy_re(r'''(?<![a-z0-9?!/'"-])>''', re.I)
 
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
         # to be encoded.
-        text = _AMPERSAND_RE.sub('&amp;', text)
+        if '&' in text:
+            text = _AMPERSAND_RE.sub('&amp;', text)
 
         # Encode naked <'s
-        text = self._naked_lt_re.sub('&lt;', text)
+        if '<' in text:
+            text = self._naked_lt_re.sub('&lt;', text)
 
         # Encode naked >'s
         # Note: Other markdown implementations (e.g. Markdown.pl, PHP
         # Markdown) don't do this.
-        text = self._naked_gt_re.sub('&gt;', text)
+        if '>' in text:
+            text = self._naked_gt_re.sub('&gt;', text)
         return text
 
-    _incomplete_tags_re = re.compile(r"<(!--|/?\w+?(?!\w)\s*?.+?[\s/]+?)")
+    _incomplete_tags_re = _lazy_re(r"<(!--|/?\w+?(?!\w)\s*?.+?[\s/]+?)")
 
     def _encode_incomplete_tags(self, text):
         if self.safe_mode not in ("replace", "escape"):
             return text
 
-        if text.endswith(">"):
-            return text  # this is not an incomplete tag, this is a link in the form <http://x.y.z>
+        if '<' not in text or text.endswith(">"):
+            return text  # no tags, or a link in the form <http://x.y.z>
 
         def incomplete_tags_sub(match):
             return match.group().replace('<', '&lt;')
 
         return self._incomplete_tags_re.sub(incomplete_tags_sub, text)
 
+    _backslash_escaped_re = _lazy_re(r'\\(.)', re.S)
+
     def _encode_backslash_escapes(self, text):
+        if '\\' not in text:
+            return text
+        # `_escape_table` also holds every URL seen so far (see _protect_url),
+        # so only try the keys that can match after one of the backslashes.
+        escaped = set(self._backslash_escaped_re.findall(text))
         for ch, escape in list(self._escape_table.items()):
-            text = text.replace("\\"+ch, escape)
+            if ch[:1] in escaped:
+                text = text.replace("\\"+ch, escape)
         return text
 
-    _auto_link_re = re.compile(r'<((https?|ftp):[^\'">\s]+)>', re.I)
+    _auto_link_re = _lazy_re(r'<((https?|ftp):[^\'">\s]+)>', re.I)
     def _auto_link_sub(self, match):
         g1 = match.group(1)
         return '<a href="%s">%s</a>' % (self._protect_url(g1), g1)
 
-    _auto_email_link_re = re.compile(r"""
+    _auto_email_link_re = _lazy_re(r"""
           <
            (?:mailto:)?
           (
@@ -2284,6 +2906,8 @@ class Markdown(object):
             self._unescape_special_chars(match.group(1)))
 
     def _do_auto_links(self, text):
+        if '<' not in text:
+            return text
         text = self._auto_link_re.sub(self._auto_link_sub, text)
         text = self._auto_email_link_re.sub(self._auto_email_link_sub, text)
         return text
@@ -2308,18 +2932,52 @@ class Markdown(object):
                % (''.join(chars), ''.join(chars[7:]))
         return addr
 
+    _hash_re = _lazy_re(r'md5-[0-9a-f]{32}')
+    _unhash_state = None
+
     def _unescape_special_chars(self, text):
         # Swap back in all the special characters we've hidden.
-        hashmap = tuple(self._escape_table.items()) + tuple(self._code_table.items())
-        # html_blocks table is in format {hash: item} compared to usual {item: hash}
-        hashmap += tuple(tuple(reversed(i)) for i in self.html_blocks.items())
-        while True:
-            orig_text = text
-            for ch, hash in hashmap:
-                text = text.replace(hash, ch)
-            if text == orig_text:
-                break
-        return text
+        if 'md5-' not in text:
+            return text
+        table = self._unhash_table()
+        unhashed = self._unhashed
+
+        def unhash_sub(match):
+            key = match.group()
+            try:
+                return unhashed[key]
+            except KeyError:
+                pass
+            value = table.get(key)
+            if value is None:
+                return key
+            # Hashed values can contain other hashes (e.g. a code span inside
+            # an HTML block), restore those before caching the result.
+            if 'md5-' in value:
+                value = self._hash_re.sub(unhash_sub, value)
+            unhashed[key] = value
+            return value
+
+        return self._hash_re.sub(unhash_sub, text)
+
+    def _unhash_table(self):
+        """Return a `{hash: text}` dict merged from `_escape_table`,
+        `_code_table` and `html_blocks`.
+
+        The tables only ever gain entries during a conversion, so the merged
+        dict is rebuilt only when one of them has grown.
+        """
+        state = (id(self.html_blocks), len(self._escape_table),
+                 len(self._code_table), len(self.html_blocks))
+        if self._unhash_state != state:
+            # html_blocks table is in format {hash: item} compared to usual {item: hash}
+            table = {hash: ch for ch, hash in self._escape_table.items()}
+            table.update((hash, ch) for ch, hash in self._code_table.items())
+            table.update(self.html_blocks)
+            self._unhash_tbl = table
+            self._unhashed = {}
+            self._unhash_state = state
+        return self._unhash_tbl
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -2418,9 +3076,365 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "fenced-code-blocks"]
 
 
+class _BlockMarkdown(Markdown):
+    """The `Markdown` that `IncrementalMarkdown` converts one block at a
+    time with. Link definitions can be anywhere in a document, so after
+    stripping a block's own ones it takes those of the whole document from
+    `link_defs`, and keeps the block's own in `own_link_defs`.
+    """
+    link_defs = None
+    own_link_defs = ({}, {})
+    only_link_defs = False  # nothing but link definitions in the block
+
+    def reset(self):
+        # every conversion is of (part of) the same document, so header ids
+        # must not keep counting from the last one, even without reset-count
+        self.__dict__.pop('_count_from_header_id', None)
+        super().reset()
+
+    def _strip_link_definitions(self, text):
+        text = super()._strip_link_definitions(text)
+        self.own_link_defs = (dict(self.urls), dict(self.titles))
+        self.only_link_defs = not text.strip()
+        if self.link_defs is not None:
+            urls, titles = self.link_defs
+            self.urls.update(urls)
+            self.titles.update(titles)
+        return text
+
+
+class IncrementalMarkdown(object):
+    r"""Convert Markdown that arrives a chunk at a time (e.g. a streamed LLM
+    reply) without re-converting the whole text for every chunk.
+
+    Completed top-level blocks are converted once and their HTML is kept.
+    Only the trailing, still-open block is re-converted on each `feed()`,
+    and what `feed()` returns is what `convert()` would for the text so far.
+
+        >>> im = IncrementalMarkdown()
+        >>> im.feed("*boo")
+        '<p>*boo</p>\n'
+        >>> im.feed("!*\n\nmore")
+        '<p><em>boo!</em></p>\n\n<p>more</p>\n'
+        >>> im.flush()
+        '<p><em>boo!</em></p>\n\n<p>more</p>\n'
+
+    The items of a loose list are kept as they come too, and joined up with
+    the rest of the list on each `feed()`.
+
+    Kept blocks that use reference links are converted again when a link
+    definition further down changes what they point to. Extras that number
+    or collect things across the whole document (footnotes, toc,
+    header-ids, numbering, metadata) turn the caching off: each `feed()`
+    then converts everything fed so far.
+
+        >>> import random
+        >>> text = ("Some *text* and [a link][1].\n\n> a quote\n\n> goes on\n\n"
+        ...         "* one\n\n[2]: http://example.org\n\n* two\n\n    code\n\n"
+        ...         "1. three [b][2]\n\n2. four\n\n    more\n\n3. five\n\n"
+        ...         "[1]: http://example.com\n")
+        >>> rnd = random.Random(0)
+        >>> for _ in range(20):
+        ...     im.reset()
+        ...     pos = 0
+        ...     while pos < len(text):
+        ...         step = rnd.randint(1, 8)
+        ...         html = im.feed(text[pos:pos + step])
+        ...         pos += step
+        ...     assert html == im.flush() == markdown(text)
+
+    Each `feed()` numbers duplicate header ids afresh, so they match a
+    single conversion of the text even with dict-form `header-ids`:
+
+        >>> im = IncrementalMarkdown(extras={'header-ids': {}})
+        >>> text = "# Hello\n\ntext\n\n# Hello\n"
+        >>> for pos in range(0, len(text), 5):
+        ...     html = im.feed(text[pos:pos + 5])
+        ...     assert html == markdown(text[:pos + 5], extras={'header-ids': {}})
+        >>> print(html)
+        <h1 id="hello">Hello</h1>
+        <BLANKLINE>
+        <p>text</p>
+        <BLANKLINE>
+        <h1 id="hello-2">Hello</h1>
+        <BLANKLINE>
+
+    The constructor takes the same arguments as `Markdown`.
+    """
+    _fence_re = _lazy_re(r'^[ \t]*(`{3,})')
+    _cont_line_re = _lazy_re(r'[ \t><]|(?:[*+-]|\d+\.)[ \t]')
+    _link_def_start_re = _lazy_re(r'\[[^\]\n]+\]:')
+    _list_marker_re = _lazy_re(r'([*+-]|\d+\.)[ \t]')
+    _list_open_re = _lazy_re(r'<[ou]l\b[^>]*>\n')
+    # the <li> of the one word item standing in for a list's kept items
+    _stand_in_li = '<li><p>x</p></li>\n'
+    _html_block_tag_re = _lazy_re(r'^</?(%s)\b' % Markdown._block_tags_b, re.M)
+    _open_comment_re = _lazy_re(r'<!--(?:(?!-->).)*(?:\Z|-->(?![ \t]*(?:\n\n|\n?\Z)))', re.S)
+    _document_extras = frozenset(('footnotes', 'toc', 'header-ids', 'numbering', 'metadata'))
+
+    def __init__(self, *args, **kwargs):
+        self._md = _BlockMarkdown(*args, **kwargs)
+        self.reset()
+
+    def reset(self):
+        # convert everything fed so far on each `feed()`
+        self._whole = self._md.use_file_vars or not self._document_extras.isdisjoint(self._md.extras)
+        self._text = []       # every chunk fed so far
+        self._blocks = []     # [source, html] of each committed block
+                              # ('' for a block of link definitions)
+        self._block_defs = ({}, {})  # link definitions in the committed blocks
+        self._link_defs = ({}, {})   # ... and in the whole text, last converted with
+        self._pending = ''    # source of the open (uncommitted) blocks
+        self._list_source = ''  # source of the kept items of a loose list
+                                # that `_pending` goes on with
+        self._list_html = ''    # ... their <li>s
+        self._list_marker = ''  # ... and the list's first marker
+        self._list_open = ''    # ... and opening tag
+        self._scan_pos = 0    # start of the first unscanned line in `_pending`
+        self._fence = None    # opening fence if `_pending` ends inside one
+        self._blank = False   # last scanned line was blank
+        self._indented = False  # last non-blank line may be in a code block
+
+    @property
+    def text(self):
+        """All of the Markdown fed so far."""
+        return ''.join(self._text)
+
+    def feed(self, chunk):
+        """Add `chunk` to the document and return the HTML for everything
+        fed so far.
+        """
+        self._text.append(chunk)
+        if self._whole:
+            return self.flush()
+        self._pending += chunk
+        self._commit_blocks()
+        if not self._blocks and not self._list_source:
+            self._md.link_defs = None
+            return self._md.convert(self._pending)
+        tail, tail_defs = self._convert_pending()
+
+        link_defs = (dict(self._block_defs[0], **tail_defs[0]),
+                     dict(self._block_defs[1], **tail_defs[1]))
+        if link_defs != self._link_defs:
+            if any(self._md._hash_re.search(value)
+                   for defs in link_defs for value in defs.values()):
+                # (e.g. HTML in a title in safe mode) only means something
+                # in the conversion it came from
+                self._whole = True
+                return self.flush()
+            # a block may have been converted before a definition it uses
+            self._link_defs = link_defs
+            for block in self._blocks:
+                if '[' in block[0]:
+                    block[1] = self._convert(block[0])[0]
+            if '[' in self._list_source:
+                self._list_html = self._convert_list_items(self._list_source, first=True)[0]
+                if self._list_html is None:
+                    self._reopen_list()
+            tail = self._convert_pending()[0]
+
+        html = [block[1] for block in self._blocks if block[1]]
+        if tail and self._pending.strip():
+            html.append(tail)
+        return '\n'.join(html)
+
+    def flush(self):
+        """Return the exact conversion of everything fed so far."""
+        self._md.link_defs = None
+        return self._md.convert(self.text)
+
+    def _convert(self, text):
+        """Convert one block of the document, returning its HTML and its
+        own link definitions.
+        """
+        self._md.link_defs = self._link_defs
+        html = self._md.convert(text)
+        if self._md.only_link_defs:
+            html = ''
+        return html, self._md.own_link_defs
+
+    def _convert_pending(self):
+        """Convert `_pending`, going on with the open list if there is one."""
+        if self._list_source:
+            converted = self._convert_after_list(self._pending)
+            if converted:
+                return converted
+            self._reopen_list()
+        return self._convert(self._pending)
+
+    def _reopen_list(self):
+        # the open list didn't go on the way it started: put its kept items
+        # back, to be converted whole with the rest of it
+        self._pending = self._list_source + self._pending
+        self._scan_pos += len(self._list_source)
+        self._list_source = self._list_html = ''
+
+    def _commit_blocks(self):
+        """Convert and store every block in `_pending` that later input can
+        no longer change.
+
+        A block is finished when a blank line is followed by a line that
+        starts in the first column and can't continue it: not indented
+        (code block, list item content), not a list marker (loose list), a
+        `>` (block quote), a `<` (HTML, which is hashed depending on what
+        is around it), a code fence or a link definition (the text on
+        either side of it joins up when it is stripped), and not inside a
+        fenced code block or an open HTML block or comment. As with the
+        linear engine's `_split_blocks`, a block doesn't end with an
+        indented line either (a code block is output without the blank
+        lines after it), nor with a link definition, which takes them
+        along when it is stripped.
+
+        The items of a loose list are kept one batch at a time instead (see
+        `_commit_list_items()`), so a long list isn't converted whole on
+        every `feed()`.
+        """
+        pending = self._pending
+        pos = self._scan_pos
+        while True:
+            eol = pending.find('\n', pos)
+            if eol == -1:
+                break
+            line = pending[pos:eol]
+            if self._fence:
+                if line.strip() == self._fence:
+                    self._fence = None
+            elif not line.strip():
+                self._blank = True
+            else:
+                commit = None
+                if self._blank and pending[:pos].strip():
+                    if (not self._indented
+                            and not self._cont_line_re.match(line)
+                            and not self._fence_re.match(line)
+                            and not self._link_def_start_re.match(line)):
+                        commit = self._commit
+                    elif self._starts_next_item(pending[:pos], line):
+                        commit = self._commit_list_items
+                if (commit and self._html_blocks_closed(pending[:pos])
+                        and not self._ends_with_link_def(pending[:pos])
+                        and commit(pending[:pos]) is not False):
+                    pending = pending[pos:]
+                    eol -= pos
+                    pos = 0
+                fence = self._fence_re.match(line)
+                if fence:
+                    self._fence = fence.group(1)
+                self._blank = False
+                self._indented = line.startswith(('\t', self._md.tab))
+            pos = eol + 1
+        self._pending = pending
+        self._scan_pos = pos
+
+    def _commit(self, source):
+        converted = None
+        if self._list_source:
+            # the rest of the open list, and whatever follows it
+            converted = self._convert_after_list(source)
+            source = self._list_source + source
+            self._list_source = self._list_html = ''
+        html, (urls, titles) = converted or self._convert(source)
+        self._blocks.append([source, html])
+        self._block_defs[0].update(urls)
+        self._block_defs[1].update(titles)
+
+    def _list_kind(self, line):
+        if self._md._hr_re.match(line):
+            return None
+        marker = self._list_marker_re.match(line)
+        return marker and ('ol' if marker.group(1)[0].isdigit() else 'ul')
+
+    def _starts_next_item(self, text, line):
+        """Whether `line` starts another item of a top-level list that is
+        all `text` (and the list's kept items) has in it.
+        """
+        kind = self._list_kind(line)
+        if not kind or kind != self._list_kind(self._list_source or text):
+            return False
+        blank = True
+        for text_line in text.split('\n'):
+            if not text_line.strip():
+                blank = True
+                continue
+            if text_line[0] not in ' \t':
+                text_kind = self._list_kind(text_line)
+                if (self._md._hr_re.match(text_line) or (text_kind or blank) and text_kind != kind):
+                    # the list ends, or a horizontal rule splits it
+                    return False
+            blank = False
+        return True
+
+    def _commit_list_items(self, source):
+        """Keep the HTML of the loose list items in `source`, to be joined
+        up with that of the rest of the list (see `_convert_after_list()`).
+        Returns False if they can't be converted apart from it.
+        """
+        if not self._list_source:
+            self._list_marker = self._list_marker_re.match(source).group(1)
+        html, (urls, titles) = self._convert_list_items(source, first=not self._list_source)
+        if html is None:
+            return False
+        self._list_source += source
+        self._list_html += html
+        self._block_defs[0].update(urls)
+        self._block_defs[1].update(titles)
+
+    def _convert_list_items(self, source, first):
+        """Convert the list items in `source` followed by a stand-in item
+        (and preceded by one unless they are the `first` of the list) and
+        return the <li>s of the items, or None if they didn't come out as
+        items of one list.
+        """
+        stand_in = self._list_marker + ' x\n'
+        html, defs = self._convert(source + stand_in if first else stand_in + '\n' + source + stand_in)
+        opening = self._list_open_re.match(html)
+        if not opening or (not first and opening.group() != self._list_open):
+            return None, defs
+        head = opening.group() + ('' if first else self._stand_in_li)
+        end = html.rfind(self._stand_in_li)
+        if (not html.startswith(head) or end < len(head)
+                or html[end + len(self._stand_in_li):] != '</%s>\n' % html[1:3]):
+            return None, defs
+        self._list_open = opening.group()
+        return html[len(head):end], defs
+
+    def _convert_after_list(self, text):
+        """Convert `text`, which goes on with the open list, and join up the
+        HTML of the list's kept items with it. Returns None if the list
+        doesn't go on as it started.
+        """
+        html, defs = self._convert(self._list_marker + ' x\n\n' + text)
+        head = self._list_open + self._stand_in_li
+        if not html.startswith(head):
+            return None
+        return self._list_open + self._list_html + html[len(head):], defs
+
+    def _ends_with_link_def(self, text):
+        if ']:' not in text:
+            return False
+        return any(match.end() == len(text)
+                   for match in self._md._patterns.link_def_re.finditer(text))
+
+    def _html_blocks_closed(self, text):
+        if '<' not in text:
+            return True
+        if '<!--' in text and (text.count('<!--') != text.count('-->')
+                               or self._open_comment_re.search(text)):
+            # an open comment (only one followed by a blank line is closed),
+            # or one a stray --> further on may change
+            return False
+        if '</code>' in text:
+            return False
+        for tag in set(self._html_block_tag_re.findall(text)):
+            if not self._md._tag_is_closed(tag, text):
+                return False
+        return True
+
+
+# ----------------------------------------------------------
+# Extras
 # ----------------------------------------------------------
-# Extras
-# ----------------------------------------------------------
 
 # Base classes
 # ----------------------------------------------------------
@@ -2428,6 +3442,11 @@ class MarkdownWithExtras(Markdown):
 class Extra(ABC):
     _registry = {}
     _exec_order: Dict[Stage, Tuple[List['Extra'], List['Extra']]] = {}
+    _registry_version = 0
+    '''
+    Bumped whenever the registry changes, so `Markdown` instances know to
+    recompile their extra execution plan
+    '''
 
     name: str
     '''
@@ -2456,6 +3475,7 @@ class Extra(ABC):
         '''
         if cls.name in cls._registry:
             del cls._registry[cls.name]
+        Extra._registry_version += 1
 
         for exec_order in Extra._exec_order.values():
             # find everywhere this extra is mentioned and remove it
@@ -2470,6 +3490,7 @@ class Extra(ABC):
         the `order` class attribute.
         '''
         cls._registry[cls.name] = cls
+        Extra._registry_version += 1
 
         for index, item in enumerate((*cls.order[0], *cls.order[1])):
             before = index < len(cls.order[0])
@@ -2549,14 +3570,14 @@ class ItalicAndBoldProcessor(Extra):
 
     def sub_hash(self, match):
         substr = match.string[match.start(): match.end()]
-        key = _hash_text(substr)
+        key = self.md._hash_text(substr)
         self.hash_table[key] = substr
         return key
 
     def test(self, text):
         if self.md.order < Stage.ITALIC_AND_BOLD:
             return '*' in text or '_' in text
-        return self.hash_table and re.search(r'md5-[0-9a-z]{32}', text)
+        return self.hash_table and 'md5-' in text
 
 # User facing extras
 # ----------------------------------------------------------
@@ -2572,7 +3593,7 @@ class Admonitions(Extra):
 
     admonitions = r'admonition|attention|caution|danger|error|hint|important|note|tip|warning'
 
-    admonitions_re = re.compile(r'''
+    admonitions_re = _lazy_re(r'''
         ^(\ *)\.\.\ (%s)::\ *                # $1 leading indent, $2 the admonition
         (.*)?                                # $3 admonition title
         ((?:\s*\n\1\ {3,}.*)+?)              # $4 admonition body (required)
@@ -2650,7 +3671,7 @@ class CodeFriendly(ItalicAndBoldProcessor):
         if '_' not in syntax:
             return super().sub(match)
         text = match.string[match.start(): match.end()]
-        key = _hash_text(text)
+        key = self.md._hash_text(text)
         self.hash_table[key] = text
         return key
 
@@ -2666,12 +3687,18 @@ class FencedCodeBlocks(Extra):
     name = 'fenced-code-blocks'
     order = (Stage.LINK_DEFS, Stage.BLOCK_GAMUT), (Stage.PREPROCESS,)
 
-    fenced_code_block_re = re.compile(r'''
+    fenced_code_block_re = _lazy_re(r'''
         (?:\n+|\A\n?|(?<=\n))
         (^[ \t]*`{3,})\s{0,99}?([\w+-]+)?\s{0,99}?\n  # $1 = opening fence (captured for back-referencing), $2 = optional lang
         (.*?)                             # $3 = code block content
         \1[ \t]*\n                      # closing fence
         ''', re.M | re.X | re.S)
+    # Without `\s` matching newlines around the language name, an unclosed
+    # fence followed by many blank lines doesn't backtrack over all of them
+    hardened_fenced_code_block_re = _lazy_re(
+        fenced_code_block_re.pattern.replace(r'\s{0,99}?', r'[ \t]{0,99}?'),
+        re.M | re.X | re.S)
+    _opening_fence_re = _lazy_re(r"^[ \t]*`{3,}", re.M)
 
     def test(self, text):
         if '```' not in text:
@@ -2686,8 +3713,7 @@ class FencedCodeBlocks(Extra):
         formatter_opts = self.md.extras['fenced-code-blocks'] or {}
 
         def unhash_code(codeblock):
-            for key, sanitized in list(self.md.html_spans.items()):
-                codeblock = codeblock.replace(key, sanitized)
+            codeblock = self.md._unhash_html_spans(codeblock)
             replacements = [
                 ("&amp;", "&"),
                 ("&lt;", "<"),
@@ -2749,8 +3775,41 @@ class FencedCodeBlocks(Extra):
         return "\n%s%s%s\n%s\n" % (leading_indent, tags[0], codeblock, tags[1])
 
     def run(self, text):
+        if self.md.hardened:
+            return self._hardened_sub(text)
         return self.fenced_code_block_re.sub(self.sub, text)
 
+    def _hardened_sub(self, text):
+        """`hardened_fenced_code_block_re.sub(self.sub, text)`, but only trying
+        the regex (from the blank lines before it) at an opening fence with a
+        closing fence somewhere after it, rather than letting each unclosed
+        fence, or each of the blank lines before one, rescan the rest of the
+        text.
+        """
+        last_close = {}
+        result = []
+        pos = 0
+        for match in self._opening_fence_re.finditer(text):
+            start, fence = match.start(), match.group()
+            if start < pos:
+                continue
+            if fence not in last_close:
+                last_close[fence] = max(
+                    (m.start() for m in re.finditer(re.escape(fence) + r'[ \t]*\n', text)),
+                    default=-1)
+            eol = text.find('\n', match.end())
+            if eol == -1 or last_close[fence] <= eol:
+                continue
+            while start > pos and text[start - 1] == '\n':
+                start -= 1
+            match = self.hardened_fenced_code_block_re.match(text, start)
+            if match:
+                result.append(text[pos:start])
+                result.append(self.sub(match))
+                pos = match.end()
+        result.append(text[pos:])
+        return ''.join(result)
+
 
 class LinkPatterns(Extra):
     '''
@@ -2760,67 +3819,175 @@ class LinkPatterns(Extra):
     name = 'link-patterns'
     order = (Stage.LINKS,), ()
 
-    _basic_link_re = re.compile(r'!?\[.*?\]\(.*?\)')
+    _basic_link_re = _lazy_re(r'!?\[.*?\]\(.*?\)')
+    # Backreferences and conditionals refer to groups by number or name, so
+    # patterns using them can't be combined with others.
+    _group_ref_re = _lazy_re(r'\\[1-9]|\(\?P=|\(\?\(')
+    # The literal text a pattern starts with, after any anchors
+    _literal_prefix_re = _lazy_re(r'(?:\\[bBA]|\^)*((?:[^\\.^$*+?{}\[\]|()]|\\\W)*)(.?)')
+
+    def __init__(self, md: Markdown, options: Optional[list]):
+        super().__init__(md, options)
+        self._scan = None
+        self._prefixes = None
 
     def run(self, text):
+        if self._scan is None:
+            self._scan = self._compile_scan()
+        if self._scan and not self._scan.search(text):
+            return text
         link_from_hash = {}
         for regex, repl in self.options:
-            replacements = []
-            for match in regex.finditer(text):
-                if any(self.md._match_overlaps_substr(text, match, h) for h in link_from_hash):
-                    continue
+            text = self._link_pass(text, regex, repl, link_from_hash)
+        if not link_from_hash:
+            return text
 
-                if hasattr(repl, "__call__"):
-                    href = repl(match)
-                else:
-                    href = match.expand(repl)
-                replacements.append((match.span(), href))
-            for (start, end), href in reversed(replacements):
+        def unhash_sub(match):
+            key = match.group()
+            return link_from_hash.get(key, key)
 
-                # Do not match against links inside brackets.
-                if text[start - 1:start] == '[' and text[end:end + 1] == ']':
-                    continue
+        return self.md._hash_re.sub(unhash_sub, text)
 
-                # Do not match against links in the standard markdown syntax.
-                if text[start - 2:start] == '](' or text[end:end + 2] == '")':
-                    continue
+    def _compile_scan(self):
+        r'''
+        Returns one regex matching wherever any of the patterns would, or
+        False if they can't be combined. It only tells `run` whether there is
+        anything to link at all: the patterns are still applied one after
+        another, so an earlier pattern keeps priority over a later one.
 
-                # Do not match against links which are escaped.
-                if text[start - 3:start] == '"""' and text[end:end + 3] == '"""':
-                    text = text[:start - 3] + text[start:end] + text[end + 3:]
-                    continue
+        Patterns can be combined if they share their flags and don't refer
+        to their own groups.
 
-                # search the text for anything that looks like a link
-                is_inside_link = False
-                for link_re in (self.md._auto_link_re, self._basic_link_re):
-                    for match in link_re.finditer(text):
-                        if any((r[0] <= start and end <= r[1]) for r in match.regs):
-                            # if the link pattern start and end pos is within the bounds of
-                            # something that looks like a link, then don't process it
-                            is_inside_link = True
-                            break
-                    else:
-                        continue
-                    break
+        >>> patterns = [(re.compile(r'z\.com'), 'http://a'),
+        ...             (re.compile(r'chttp://z\.com'), 'http://b')]
+        >>> markdown('chttp://z.com', extras=['link-patterns'], link_patterns=patterns)
+        '<p>chttp://<a href="http://a">z.com</a></p>\n'
+        '''
+        options = list(self.options)
+        if len(options) > 1:
+            flags = options[0][0].flags
+            if all(regex.flags == flags and not self._group_ref_re.search(regex.pattern)
+                   for regex, _ in options):
+                # a trailing comment in a verbose pattern would swallow the ')'
+                newline = '\n' if flags & re.X else ''
+                try:
+                    return re.compile('|'.join('(?:%s%s)' % (regex.pattern, newline)
+                                               for regex, _ in options), flags)
+                except re.error:
+                    pass  # e.g. the same group name in two patterns
+        return False
 
-                if is_inside_link:
-                    continue
+    def _link_spans(self, text):
+        '''
+        Returns `(starts, ends)` for everything in `text` that looks like a
+        link (and each of its groups), sorted by start. `ends[i]` is the
+        furthest that any of the first `i + 1` of them reach.
+        '''
+        spans = []
+        for link_re in (self.md._auto_link_re, self._basic_link_re):
+            for match in link_re.finditer(text):
+                spans.extend(r for r in match.regs if r[0] >= 0)
+        spans.sort()
+        starts = []
+        ends = []
+        furthest = -1
+        for start, end in spans:
+            furthest = max(furthest, end)
+            starts.append(start)
+            ends.append(furthest)
+        return starts, ends
+
+    def _link_pass(self, text, regex, repl, link_from_hash):
+        '''
+        Replaces the matches of `regex` in `text` with hashed links (recorded
+        in `link_from_hash`). The bracket, escape and existing-link checks
+        all look at `text` as it was before the pass.
+        '''
+        # where the links hashed by earlier passes are
+        hash_starts = []
+        hash_ends = []
+        if link_from_hash:
+            for match in self.md._hash_re.finditer(text):
+                if match.group() in link_from_hash:
+                    hash_starts.append(match.start())
+                    hash_ends.append(match.end())
+
+        def overlaps_hash(pos):
+            i = bisect_right(hash_starts, pos) - 1
+            return i >= 0 and pos <= hash_ends[i]
 
-                escaped_href = (
-                    href.replace('"', '&quot;')  # b/c of attr quote
-                        # To avoid markdown <em> and <strong>:
-                        .replace('*', self.md._escape_table['*'])
-                        .replace('_', self.md._escape_table['_']))
-                link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
-                link_from_hash[hash] = link
-                text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+        replacements = []
+        for match in regex.finditer(text):
+            start, end = match.span()
+            if hash_starts and (overlaps_hash(start) or overlaps_hash(end)):
+                continue
+            if hasattr(repl, "__call__"):
+                href = repl(match)
+            else:
+                href = match.expand(repl)
+            replacements.append((start, end, href))
+        if not replacements:
+            return text
+
+        link_starts = link_ends = None
+        edits = []
+        for start, end, href in replacements:
+            # Do not match against links inside brackets.
+            if text[start - 1:start] == '[' and text[end:end + 1] == ']':
+                continue
+
+            # Do not match against links in the standard markdown syntax.
+            if text[start - 2:start] == '](' or text[end:end + 2] == '")':
+                continue
+
+            # Do not match against links which are escaped.
+            if ((not edits or start - 3 >= edits[-1][1])
+                    and text[start - 3:start] == '"""' and text[end:end + 3] == '"""'):
+                edits.append((start - 3, end + 3, text[start:end]))
+                continue
+
+            # if the link pattern start and end pos is within the bounds of
+            # something that looks like a link, then don't process it
+            if link_starts is None:
+                link_starts, link_ends = self._link_spans(text)
+            i = bisect_right(link_starts, start) - 1
+            if i >= 0 and end <= link_ends[i]:
+                continue
+
+            escaped_href = (
+                href.replace('"', '&quot;')  # b/c of attr quote
+                    # To avoid markdown <em> and <strong>:
+                    .replace('*', self.md._escape_table['*'])
+                    .replace('_', self.md._escape_table['_']))
+            link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
+            hash = self.md._hash_text(link)
+            link_from_hash[hash] = link
+            edits.append((start, end, hash))
+        return _apply_edits(text, edits)
+
+    def _literal_prefixes(self):
+        '''
+        Returns the literal text that each match of each pattern starts
+        with, or an empty tuple if that can't be worked out for all of them.
+        '''
+        prefixes = []
+        for regex, _ in self.options:
+            if regex.flags & re.X or '|' in regex.pattern:
+                return ()
+            literal, following = self._literal_prefix_re.match(regex.pattern).groups()
+            if following in ('*', '?', '{'):
+                # the last character is optional
+                literal = literal[:-2] if literal[-2:-1] == '\\' else literal[:-1]
+            literal = re.sub(r'\\(.)', r'\1', literal)
+            if not literal or (regex.flags & re.I and literal.lower() != literal.upper()):
+                return ()
+            prefixes.append(literal)
+        return tuple(prefixes)
 
     def test(self, text):
-        return True
+        if self._prefixes is None:
+            self._prefixes = self._literal_prefixes()
+        return not self._prefixes or any(prefix in text for prefix in self._prefixes)
 
 
 class MarkdownInHTML(Extra):
@@ -2843,7 +4010,7 @@ class MarkdownInHTML(Extra):
         return self.md._strict_tag_block_sub(text, self.md._block_tags_a, callback, True)
 
     def test(self, text):
-        return True
+        return '<' in text
 
 
 class Mermaid(FencedCodeBlocks):
@@ -2901,7 +4068,7 @@ class MiddleWordEm(ItalicAndBoldProcessor):
 
     def sub_hash(self, match):
         text = match.string[match.start(): match.end()]
-        key = _hash_text(text)
+        key = self.md._hash_text(text)
         self.hash_table[key] = text
         return key
 
@@ -2915,18 +4082,21 @@ class Numbering(Extra):
     name = 'numbering'
     order = (Stage.LINK_DEFS,), ()
 
+    _defns_re = _lazy_re(r'''
+        \[\#(\w+) # the counter.  Open square plus hash plus a word \1
+        ([^@]*)   # Some optional characters, that aren't an @. \2
+        @(\w+)       # the id.  Should this be normed? \3
+        ([^\]]*)\]   # The rest of the text up to the terminating ] \4
+        ''', re.VERBOSE)
+    _subs_re = _lazy_re(r"\[@(\w+)\s*\]")  # [@ref_id]
+
     def test(self, text):
-        return True
+        return '[#' in text or '[@' in text
 
     def run(self, text):
         # First pass to define all the references
-        regex_defns = re.compile(r'''
-            \[\#(\w+) # the counter.  Open square plus hash plus a word \1
-            ([^@]*)   # Some optional characters, that aren't an @. \2
-            @(\w+)       # the id.  Should this be normed? \3
-            ([^\]]*)\]   # The rest of the text up to the terminating ] \4
-            ''', re.VERBOSE)
-        regex_subs = re.compile(r"\[@(\w+)\s*\]")  # [@ref_id]
+        regex_defns = self._defns_re
+        regex_subs = self._subs_re
         counters = {}
         references = {}
         replacements = []
@@ -2943,21 +4113,19 @@ class Numbering(Extra):
             number = counters.get(counter, 1)
             references[ref_id] = (number, counter)
             replacements.append((match.start(0),
+                                 match.end(0),
                                  definition_html.format(counter,
                                                         ref_id,
                                                         text_before,
                                                         number,
-                                                        text_after),
-                                 match.end(0)))
+                                                        text_after)))
             counters[counter] = number + 1
-        for repl in reversed(replacements):
-            text = text[:repl[0]] + repl[1] + text[repl[2]:]
+        text = _apply_edits(text, replacements)
 
         # Second pass to replace the references with the right
         # value of the counter
-        # Fwiw, it's vaguely annoying to have to turn the iterator into
-        # a list and then reverse it but I can't think of a better thing to do.
-        for match in reversed(list(regex_subs.finditer(text))):
+        replacements = []
+        for match in regex_subs.finditer(text):
             number, counter = references.get(match.group(1), (None, None))
             if number is not None:
                 repl = reference_html.format(counter,
@@ -2970,8 +4138,8 @@ class Numbering(Extra):
             if "smarty-pants" in self.md.extras:
                 repl = repl.replace('"', self.md._escape_table['"'])
 
-            text = text[:match.start()] + repl + text[match.end():]
-        return text
+            replacements.append((match.start(), match.end(), repl))
+        return _apply_edits(text, replacements)
 
 
 class PyShell(Extra):
@@ -3000,14 +4168,7 @@ class PyShell(Extra):
         return s
 
     def run(self, text):
-        less_than_tab = self.md.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n  # first line
-            ^(\1[^\S\n]*\S.*\n)*    # any number of subsequent lines with at least one character
-            (?=^\1?\n|\Z)           # ends with a blank line or end of document
-            """ % less_than_tab, re.M | re.X)
-
-        return _pyshell_block_re.sub(self.sub, text)
+        return self.md._patterns.pyshell_block_re.sub(self.sub, text)
 
 
 class SmartyPants(Extra):
@@ -3019,26 +4180,27 @@ class SmartyPants(Extra):
     name = 'smarty-pants'
     order = (), (Stage.SPAN_GAMUT,)
 
-    _opening_single_quote_re = re.compile(r"(?<!\S)'(?=\S)")
-    _opening_double_quote_re = re.compile(r'(?<!\S)"(?=\S)')
-    _closing_single_quote_re = re.compile(r"(?<=\S)'")
-    _closing_double_quote_re = re.compile(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
     # "smarty-pants" extra: Very liberal in interpreting a single prime as an
     # apostrophe; e.g. ignores the fact that "round", "bout", "twer", and
     # "twixt" can be written without an initial apostrophe. This is fine because
     # using scare quotes (single quotation marks) is rare.
-    _apostrophe_year_re = re.compile(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
     _contractions = ["tis", "twas", "twer", "neath", "o", "n",
         "round", "bout", "twixt", "nuff", "fraid", "sup"]
 
-
-    def contractions(self, text):
-        text = self._apostrophe_year_re.sub(r"&#8217;\1", text)
-        for c in self._contractions:
-            text = text.replace("'%s" % c, "&#8217;%s" % c)
-            text = text.replace("'%s" % c.capitalize(),
-                "&#8217;%s" % c.capitalize())
-        return text
+    # After the quote, dash or dot, one branch per replacement in the order
+    # they take precedence. Each ends in an empty group whose number indexes
+    # the entity in `_entities` it's replaced by.
+    _smarty_re = _lazy_re(r"""
+          ' (?: (?= \d\d(?:\s|,|;|\.|\?|!|$) | %s ) ()  # apostrophe: '99, 'tis
+              | (?<!\S') (?=\S) ()                    # opening single quote
+              | (?<=\S') () )                         # closing single quote
+        | " (?: (?<!\S") (?=\S) ()                    # opening double quote
+              | (?<=\S") (?=\s|,|;|\.|\?|!|$) () )    # closing double quote
+        | - (?: -- () | - () )                        # em and en dashes
+        | \.\.\. ()                                   # ellipsis
+        """ % '|'.join(_contractions + [c.capitalize() for c in _contractions]), re.X)
+    _entities = (None, "&#8217;", "&#8216;", "&#8217;", "&#8220;", "&#8221;",
+                 "&#8212;", "&#8211;", "&#8230;")
 
     def run(self, text):
         """Fancifies 'single quotes', "double quotes", and apostrophes.
@@ -3050,20 +4212,12 @@ class SmartyPants(Extra):
         <http://code.google.com/p/python-markdown2/issues/detail?id=42> for a
         discussion of some diversion from the original SmartyPants.
         """
-        if "'" in text:  # guard for perf
-            text = self.contractions(text)
-            text = self._opening_single_quote_re.sub("&#8216;", text)
-            text = self._closing_single_quote_re.sub("&#8217;", text)
-
-        if '"' in text:  # guard for perf
-            text = self._opening_double_quote_re.sub("&#8220;", text)
-            text = self._closing_double_quote_re.sub("&#8221;", text)
+        entities = self._entities
+        text = self._smarty_re.sub(lambda match: entities[match.lastindex], text)
 
-        text = text.replace("---", "&#8212;")
-        text = text.replace("--", "&#8211;")
-        text = text.replace("...", "&#8230;")
-        text = text.replace(" . . . ", "&#8230;")
-        text = text.replace(". . .", "&#8230;")
+        if ". ." in text:  # guard for perf
+            text = text.replace(" . . . ", "&#8230;")
+            text = text.replace(". . .", "&#8230;")
 
         # TODO: Temporary hack to fix https://github.com/trentm/python-markdown2/issues/150
         if "footnotes" in self.md.extras and "footnote-ref" in text:
@@ -3084,7 +4238,7 @@ class Strike(Extra):
     name = 'strike'
     order = (Stage.ITALIC_AND_BOLD,), ()
 
-    _strike_re = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~", re.S)
+    _strike_re = _lazy_re(r"~~(?=\S)(.+?)(?<=\S)~~", re.S)
 
     def run(self, text):
         return self._strike_re.sub(r"<s>\1</s>", text)
@@ -3106,86 +4260,168 @@ class Tables(Extra):
         """Copying PHP-Markdown and GFM table syntax. Some regex borrowed from
         https://github.com/michelf/php-markdown/blob/lib/Michelf/Markdown.php#L2538
         """
-        less_than_tab = self.md.tab_width - 1
-        table_re = re.compile(r'''
-                (?:(?<=\n)|\A\n?)             # leading blank line
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (.*[|].*)[ ]*\n                   # $1: header row (at least one pipe)
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (                               # $2: underline row
-                    # underline row with leading bar
-                    (?:  \|\ *:?-+:?\ *  )+  \|? \s?[ ]*\n
-                    |
-                    # or, underline row without leading bar
-                    (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )? \s?[ ]*\n
-                )
+        return self.md._patterns.table_re.sub(self.sub, text)
+
+    _split_bar_re = _lazy_re(r'^\||(?<![\`\\])\|')
+    # Cells go through the span gamut together, joined by a separator no span
+    # can start or end in (see `_run_span_gamut_batch`), in batches of about
+    # this many characters. (Some spans are slower than linear in the length
+    # of the text they're run on, e.g. an unmatched "`" is looked for up to
+    # the end of the text.)
+    _cell_batch_size = 4096
+    _cell_tag_re = _lazy_re(r'<(/?)(\w+)([^>]*)>')
+    _void_tags = frozenset(('br', 'hr', 'img', 'input', 'wbr'))
+
+    def _split_row(self, row):
+        row = row.strip(' \t\n')
+        if row.startswith('|'):
+            row = row[1:]
+        if row.endswith('|'):
+            row = row[:-1]
+        return [cell.strip().replace('\\|', '|') for cell in self._split_bar_re.split(row)]
+
+    def _tags_balanced(self, html):
+        stack = []
+        for close, tag, attrs in self._cell_tag_re.findall(html):
+            tag = tag.lower()
+            if close:
+                if not stack or stack.pop() != tag:
+                    return False
+            elif not attrs.endswith('/') and tag not in self._void_tags:
+                stack.append(tag)
+        return not stack
+
+    def _run_span_gamut_batch(self, cells):
+        r'''
+        Run the span gamut over `cells` joined together, or one at a time if
+        a span ran across cells. Before the redo, the tables the batch added
+        to (escaped URLs and titles, code spans, HTML spans, footnotes) are
+        put back as they were, or the cells would see what later cells of
+        the batch left there:
+
+        >>> text = "| a | b |\n|---|---|\n| C:\\dir | *x |\n| y* | [l](dir) |\n"
+        >>> 'C:\\dir' in markdown(text, extras=['tables'])
+        True
+        '''
+        md = self.md
+        footnote_ids = getattr(md, 'footnote_ids', None)
+        footnote_count = len(footnote_ids) if footnote_ids is not None else 0
+        tables = (md._escape_table, md._code_table, md.html_spans)
+        saved = [dict(table) for table in tables]
+        sep = '\n%s\n' % md._hash_text('table cell')
+        html = md._run_span_gamut(sep.join(cells)).split(sep)
+        if len(html) == len(cells) and all(
+                '<' not in cell or self._tags_balanced(cell) for cell in html):
+            return html
+        # A span (say, an unclosed `*` in one cell and a stray `*` in another)
+        # ran across cells: redo them one at a time.
+        for table, entries in zip(tables, saved):
+            table.clear()
+            table.update(entries)
+        md._unhash_state = None
+        if footnote_ids is not None:
+            del footnote_ids[footnote_count:]
+        return [md._run_span_gamut(cell) for cell in cells]
+
+    def _batchable(self, cells):
+        r'''
+        Whether `cells` can go through the span gamut together. Not if an
+        extra hooked into it has its own `test()`: that would look at all the
+        cells of a batch at once, and could run the extra on cells it would
+        have skipped on their own (e.g. smarty-pants' dashes). Nor with
+        `breaks`, which would see the newline of the separator after a cell
+        ending in a backslash. Nor if one cell has a backslash and another a
+        link: `_escape_table` holds the URLs seen so far, so whether a
+        backslash escape is kept depends on which cells came before it.
+
+        >>> text = "| it's | x |\n|---|---|\n| a | b-- |\n"
+        >>> 'b--' in markdown(text, extras=['tables', 'smarty-pants'])
+        True
+        '''
+        if (any('\\' in cell for cell in cells)
+                and any('[' in cell or '<' in cell for cell in cells)):
+            return False
+        extras = self.md.extra_classes
+        for stage, sections in Extra._exec_order.items():
+            if not Stage.SPAN_GAMUT <= stage <= Stage.ITALIC_AND_BOLD:
+                continue
+            for section in sections:
+                for klass in section:
+                    extra = extras.get(klass.name)
+                    if extra is None:
+                        continue
+                    if klass is Breaks or getattr(extra.test, '__func__', None) is not Extra.test:
+                        return False
+        return True
 
-                (                               # $3: data rows
-                    (?:
-                        ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
-                        .*\|.*[ ]*\n
-                    )+
-                )
-            ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
-        return table_re.sub(self.sub, text)
+    def _run_span_gamut_cells(self, cells):
+        if not self._batchable(cells):
+            return [self.md._run_span_gamut(cell) for cell in cells]
+        html = []
+        batch = []
+        size = 0
+        for cell in cells:
+            batch.append(cell)
+            size += len(cell)
+            if size >= self._cell_batch_size:
+                html.extend(self._run_span_gamut_batch(batch))
+                batch = []
+                size = 0
+        if batch:
+            html.extend(self._run_span_gamut_batch(batch))
+        return html
 
     def sub(self, match):
-        trim_space_re = '^[ \t\n]+|[ \t\n]+$'
-        trim_bar_re = r'^\||\|$'
-        split_bar_re = r'^\||(?<![\`\\])\|'
-        escape_bar_re = r'\\\|'
-
         head, underline, body = match.groups()
 
         # Determine aligns for columns.
-        cols = [re.sub(escape_bar_re, '|', cell.strip()) for cell in re.split(split_bar_re, re.sub(trim_bar_re, "", re.sub(trim_space_re, "", underline)))]
-        align_from_col_idx = {}
-        for col_idx, col in enumerate(cols):
+        aligns = []
+        for col in self._split_row(underline):
             if col[0] == ':' and col[-1] == ':':
-                align_from_col_idx[col_idx] = ' style="text-align:center;"'
+                aligns.append(' style="text-align:center;"')
             elif col[0] == ':':
-                align_from_col_idx[col_idx] = ' style="text-align:left;"'
+                aligns.append(' style="text-align:left;"')
             elif col[-1] == ':':
-                align_from_col_idx[col_idx] = ' style="text-align:right;"'
-
-        # thead
-        hlines = ['<table%s>' % self.md._html_class_str_from_tag('table'), '<thead%s>' % self.md._html_class_str_from_tag('thead'), '<tr>']
-        cols = [re.sub(escape_bar_re, '|', cell.strip()) for cell in re.split(split_bar_re, re.sub(trim_bar_re, "", re.sub(trim_space_re, "", head)))]
-        for col_idx, col in enumerate(cols):
-            hlines.append('  <th%s>%s</th>' % (
-                align_from_col_idx.get(col_idx, ''),
-                self.md._run_span_gamut(col)
-            ))
-        hlines.append('</tr>')
-        hlines.append('</thead>')
-
-        # tbody
-        hlines.append('<tbody>')
-        for line in body.strip('\n').split('\n'):
-            hlines.append('<tr>')
-            cols = [re.sub(escape_bar_re, '|', cell.strip()) for cell in re.split(split_bar_re, re.sub(trim_bar_re, "", re.sub(trim_space_re, "", line)))]
-            for col_idx, col in enumerate(cols):
-                hlines.append('  <td%s>%s</td>' % (
-                    align_from_col_idx.get(col_idx, ''),
-                    self.md._run_span_gamut(col)
+                aligns.append(' style="text-align:right;"')
+            else:
+                aligns.append('')
+
+        rows = [self._split_row(head)]
+        rows.extend(self._split_row(line) for line in body.strip('\n').split('\n'))
+        cells = self._run_span_gamut_cells([cell for row in rows for cell in row])
+
+        hlines = ['<table%s>' % self.md._html_class_str_from_tag('table'),
+                  '<thead%s>' % self.md._html_class_str_from_tag('thead'), '<tr>']
+        n_aligns = len(aligns)
+        pos = 0
+        for row_idx, row in enumerate(rows):
+            cell_tag = 'th' if row_idx == 0 else 'td'
+            if row_idx:
+                hlines.append('<tr>')
+            for col_idx in range(len(row)):
+                hlines.append('  <%s%s>%s</%s>' % (
+                    cell_tag, aligns[col_idx] if col_idx < n_aligns else '',
+                    cells[pos], cell_tag
                 ))
+                pos += 1
             hlines.append('</tr>')
+            if not row_idx:
+                # tbody
+                hlines.extend(('</thead>', '<tbody>'))
         hlines.append('</tbody>')
         hlines.append('</table>')
 
         return '\n'.join(hlines) + '\n'
 
     def test(self, text):
-        return True
+        return '|' in text
 
 
 class TelegramSpoiler(Extra):
     name = 'tg-spoiler'
     order = (), (Stage.ITALIC_AND_BOLD,)
 
-    _tg_spoiler_re = re.compile(r"\|\|\s?(.+?)\s?\|\|", re.S)
+    _tg_spoiler_re = _lazy_re(r"\|\|\s?(.+?)\s?\|\|", re.S)
 
     def run(self, text):
         return self._tg_spoiler_re.sub(r"<tg-spoiler>\1</tg-spoiler>", text)
@@ -3201,7 +4437,7 @@ class Underline(Extra):
     name = 'underline'
     order = (Stage.ITALIC_AND_BOLD,), ()
 
-    _underline_re = re.compile(r"(?<!<!)--(?!>)(?=\S)(.+?)(?<=\S)(?<!<!)--(?!>)", re.S)
+    _underline_re = _lazy_re(r"(?<!<!)--(?!>)(?=\S)(.+?)(?<=\S)(?<!<!)--(?!>)", re.S)
 
     def run(self, text):
         return self._underline_re.sub(r"<u>\1</u>", text)
@@ -3239,7 +4475,7 @@ class Wavedrom(Extra):
                 pass
 
         # hash SVG to prevent <> chars being messed with
-        self.md._escape_table[waves] = _hash_text(waves)
+        self.md._escape_table[waves] = self.md._hash_text(waves)
 
         return self.md._uniform_indent(
             '\n%s%s%s\n' % (open_tag, self.md._escape_table[waves], close_tag),
@@ -3259,13 +4495,7 @@ class WikiTables(Extra):
     order = (Tables,), ()
 
     def run(self, text):
-        less_than_tab = self.md.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
-        return wiki_table_re.sub(self.sub, text)
+        return self.md._patterns.wiki_table_re.sub(self.sub, text)
 
     def sub(self, match):
         ttext = match.group(0).strip()
@@ -3346,37 +4576,258 @@ def calculate_toc_html(toc):
 
     def indent():
         return '  ' * (len(h_stack) - 1)
-    lines = []
+
+    def new_line(line):
+        if parts:
+            parts.append('\n')
+        parts.append(line)
+
+    parts = []      # output, joined once at the end
+    closed = False  # whether the last line ends with "</li>"
     h_stack = [0]   # stack of header-level numbers
     for level, id, name in toc:
         if level > h_stack[-1]:
-            lines.append("%s<ul>" % indent())
+            new_line("%s<ul>" % indent())
             h_stack.append(level)
         elif level == h_stack[-1]:
-            lines[-1] += "</li>"
+            parts.append("</li>")
         else:
             while level < h_stack[-1]:
                 h_stack.pop()
-                if not lines[-1].endswith("</li>"):
-                    lines[-1] += "</li>"
-                lines.append("%s</ul></li>" % indent())
-        lines.append('%s<li><a href="#%s">%s</a>' % (
-            indent(), id, name))
+                if not closed:
+                    parts.append("</li>")
+                new_line("%s</ul></li>" % indent())
+                closed = True
+        new_line('%s<li><a href="#%s">%s</a>' % (indent(), id, name))
+        closed = False
     while len(h_stack) > 1:
         h_stack.pop()
-        if not lines[-1].endswith("</li>"):
-            lines[-1] += "</li>"
-        lines.append("%s</ul>" % indent())
-    return '\n'.join(lines) + '\n'
+        if not closed:
+            parts.append("</li>")
+        new_line("%s</ul>" % indent())
+        closed = False
+    parts.append('\n')
+    return ''.join(parts)
 
 
 class UnicodeWithAttrs(str):
     """A subclass of unicode used for the return value of conversion to
     possibly attach some attributes. E.g. the "toc_html" attribute when
-    the "toc" extra is used.
+    the "toc" extra is used, "timings" -- `{label: (calls, seconds)}` for
+    each `Stage` name and `Extra` test/run method -- when converting with
+    `profile=True`, or "timed_out" when `convert()` gave up on the text.
     """
     metadata = None
     toc_html = None
+    timings = None
+    timed_out = False
+
+
+class Block(object):
+    """A top-level block of a `Document`: the name of its outermost tag
+    (e.g. "p", "h2", "ul", "pre") and its HTML, in which code, escapes and
+    nested HTML are still placeholders.
+    """
+    __slots__ = ('tag', 'html')
+
+    def __init__(self, tag, html):
+        self.tag = tag
+        self.html = html
+
+    def __getstate__(self):
+        return (self.tag, self.html)
+
+    def __setstate__(self, state):
+        self.tag, self.html = state
+
+    def __repr__(self):
+        return 'Block(%r, %r)' % (self.tag, self.html)
+
+
+class Document(object):
+    """A parsed Markdown document, as returned by `Markdown.parse()`.
+
+    `blocks` are its top-level `Block`s. `hashes` maps the placeholders in
+    them to what they stand for, `spans` does the same for HTML spans
+    sanitized in safe mode, and `class_markers` maps each tag the
+    "html-classes" extra can give a class to the placeholder standing in for
+    that class.
+    `toc` and `metadata` are the "toc" entries and "metadata" extra's
+    values, if those extras are on, and `extras` any extras turned on by
+    the text itself (see `use_file_vars`).
+
+    Documents can be pickled (e.g. to cache them) and rendered by
+    `Markdown.render()` and `Markdown.render_text()` any number of times.
+    """
+    __slots__ = ('blocks', 'hashes', 'spans', 'class_markers', 'toc', 'metadata', 'extras')
+
+    def __init__(self, blocks, hashes, spans=None, class_markers=None, toc=None,
+                 metadata=None, extras=None):
+        self.blocks = blocks
+        self.hashes = hashes
+        self.spans = spans or {}
+        self.class_markers = class_markers or {}
+        self.toc = toc
+        self.metadata = metadata
+        self.extras = extras or {}
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def _freeze(value):
+    """Return a hashable equivalent of `value`, turning lists into tuples
+    and dicts and sets into frozensets. Raises TypeError if some part of
+    it can't be hashed.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    if isinstance(value, (set, frozenset)):
+        return frozenset([_freeze(v) for v in value])
+    hash(value)
+    return value
+
+
+class _ConverterPool(object):
+    """Thread-safe pool of idle `Markdown` converters keyed by their frozen
+    constructor options.
+
+    A converter is checked out for the duration of one `convert()` call, so
+    concurrent callers never share one, and checked back in afterwards so
+    the next call with the same options skips building a new one. At most
+    `max_idle` converters are kept per key and `max_keys` keys overall, the
+    least recently used key being dropped first.
+    """
+    def __init__(self, max_keys=16, max_idle=4):
+        self.max_keys = max_keys
+        self.max_idle = max_idle
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+
+    def checkout(self, key, options):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self._idle.move_to_end(key)
+                return idle.pop()
+        return Markdown(**options)
+
+    def checkin(self, key, md):
+        md._recycle()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle is None:
+                idle = self._idle[key] = []
+                while len(self._idle) > self.max_keys:
+                    self._idle.popitem(last=False)
+            else:
+                self._idle.move_to_end(key)
+            if len(idle) < self.max_idle:
+                idle.append(md)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+
+_converter_pool = _ConverterPool()
+
+
+class _LRUCache(object):
+    """Thread-safe mapping that evicts its least recently used entries once
+    it holds more than `max_entries` of them, or once their sizes (as given
+    to `put()`) add up to more than `max_bytes`. Either limit may be None
+    for no limit.
+
+    `hits` and `misses` count `get()` calls that did and didn't find the key.
+    """
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.size += size
+            while self._data and (
+                    (self.max_entries is not None and len(self._data) > self.max_entries)
+                    or (self.max_bytes is not None and self.size > self.max_bytes)):
+                self.size -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+            self.hits = self.misses = 0
+
+
+class _RenderCache(_LRUCache):
+    """LRU cache of `markdown()` results keyed by a digest of the text and
+    the frozen converter options, so unchanged documents are not converted
+    again. Returned values are fresh `UnicodeWithAttrs` copies carrying the
+    cached `toc_html` and `metadata`.
+    """
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        super(_RenderCache, self).__init__(max_entries, max_bytes)
+
+    @staticmethod
+    def key(text, options_key):
+        data = text.encode('utf-8') if isinstance(text, str) else text
+        return sha256(data).digest(), options_key
+
+    def lookup(self, key):
+        html = self.get(key)
+        if html is None:
+            return None
+        rv = UnicodeWithAttrs(html)
+        rv.toc_html = html.toc_html
+        if html.metadata is not None:
+            rv.metadata = html.metadata.copy()
+        return rv
+
+    def store(self, key, html):
+        size = sys.getsizeof(html)
+        if html.toc_html:
+            size += sys.getsizeof(html.toc_html)
+        cached = UnicodeWithAttrs(html)
+        cached.toc_html = html.toc_html
+        if html.metadata is not None:
+            cached.metadata = html.metadata.copy()
+        self.put(key, cached, size)
+
+render_cache = _RenderCache()
+
+# Highlighted HTML of recently seen code blocks, keyed by lexer, formatter
+# options and a digest of the code (see Markdown._color_with_pygments), so
+# code quoted again later in a conversation is only highlighted once.
+_highlight_cache = _LRUCache(max_entries=256, max_bytes=4 * 1024 * 1024)
 
 ## {{{ http://code.activestate.com/recipes/577257/ (r1)
 _slugify_strip_re = re.compile(r'[^\w\s-]')
@@ -3395,6 +4846,22 @@ def _slugify(value):
 ## end of http://code.activestate.com/recipes/577257/ }}}
 
 
+def _apply_edits(text, edits):
+    """Return `text` with every `(start, end, replacement)` in `edits`
+    spliced in, in one join. `edits` must be sorted and not overlap.
+    """
+    if not edits:
+        return text
+    parts = []
+    pos = 0
+    for start, end, replacement in edits:
+        parts.append(text[pos:start])
+        parts.append(replacement)
+        pos = end
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
 # From http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/52549
 def _curry(*args, **kwargs):
     function, args = args[0], args[1:]
@@ -3525,29 +4992,85 @@ def _dedent(text, tabsize=8, skip_first_line=False):
 class _memoized(object):
     """Decorator that caches a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned, and
-    not re-evaluated.
+    not re-evaluated. Only the `maxsize` most recently used results are kept.
 
     http://wiki.python.org/moin/PythonDecoratorLibrary
     """
+    maxsize = 128
+
     def __init__(self, func):
         self.func = func
-        self.cache = {}
+        self.cache = _LRUCache(max_entries=self.maxsize)
 
     def __call__(self, *args):
         try:
-            return self.cache[args]
-        except KeyError:
-            self.cache[args] = value = self.func(*args)
-            return value
+            value = self.cache.get(args, _missing)
         except TypeError:
             # uncachable -- for instance, passing a list as an argument.
             # Better to not cache than to blow up entirely.
             return self.func(*args)
+        if value is _missing:
+            value = self.func(*args)
+            self.cache.put(args, value)
+        return value
 
     def __repr__(self):
         """Return the function's docstring."""
         return self.func.__doc__
 
+_missing = object()
+
+
+@_memoized
+def _pygments_lexer_from_name(lexer_name):
+    """The Pygments lexer for `lexer_name`, or None if there is no such
+    lexer (or Pygments isn't installed). Looking one up scans Pygments'
+    lexer registry and plugins, so each is only looked up once.
+    """
+    try:
+        from pygments import lexers, util
+    except ImportError:
+        return None
+    try:
+        return lexers.get_lexer_by_name(lexer_name)
+    except util.ClassNotFound:
+        return None
+
+
+@_memoized
+def _html_code_formatter_class():
+    """The Pygments HTML formatter used for fenced code blocks, defined on
+    first use so that Pygments stays optional.
+    """
+    import pygments.formatters
+
+    class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+        def _wrap_code(self, inner):
+            """A function for use in a Pygments Formatter which
+            wraps in <code> tags.
+            """
+            yield 0, "<code>"
+            for tup in inner:
+                yield tup
+            yield 0, "</code>"
+
+        def _add_newline(self, inner):
+            # Add newlines around the inner contents so that _strict_tag_block_re matches the outer div.
+            yield 0, "\n"
+            yield from inner
+            yield 0, "\n"
+
+        def wrap(self, source, outfile=None):
+            """Return the source with a code, pre, and div."""
+            if outfile is None:
+                # pygments >= 2.12
+                return self._add_newline(self._wrap_pre(self._wrap_code(source)))
+            else:
+                # pygments < 2.12
+                return self._wrap_div(self._add_newline(self._wrap_pre(self._wrap_code(source))))
+
+    return HtmlCodeFormatter
+
 
 def _xml_oneliner_re_from_tab_width(tab_width):
     """Standalone XML processing instruction regex."""
@@ -3591,6 +5114,193 @@ def _hr_tag_re_from_tab_width(tab_width):
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
 
+def _safe_href_re_from_protocols(safe_protocols):
+    safe = r'-\w'
+    # omitted ['"<>] for XSS reasons
+    less_safe = r'#/\.!#$%&\(\)\+,/:;=\?@\[\]^`\{\}\|~'
+    # dot seperated hostname, optional port number, not followed by protocol seperator
+    domain = r'(?:[%s]+(?:\.[%s]+)*)(?:(?<!tel):\d+/?)?(?![^:/]*:/*)' % (safe, safe)
+    fragment = r'[%s]*' % (safe + less_safe)
+
+    return re.compile(r'^(?:(%s)?(%s)(%s)|(#|\.{,2}/)(%s))$' % (safe_protocols, domain, fragment, fragment), re.I)
+_safe_href_re_from_protocols = _memoized(_safe_href_re_from_protocols)
+
+
+class _Patterns(object):
+    """The regexes whose source depends on the converter's configuration.
+
+    Built once per `(tab_width, list_level, safe_mode)` by `_patterns_for()`
+    and shared by every `Markdown` instance with that configuration, so that
+    `convert()` never compiles a pattern of its own.
+    """
+    def __init__(self, tab_width, list_level, safe_mode):
+        less_than_tab = tab_width - 1
+
+        # Link defs are in the form:
+        #   [id]: url "optional title"
+        self.link_def_re = re.compile(r"""
+            ^[ ]{0,%d}\[(.+)\]: # id = \1
+              [ \t]*
+              \n?               # maybe *one* newline
+              [ \t]*
+            <?(.+?)>?           # url = \2
+              [ \t]*
+            (?:
+                \n?             # maybe one newline
+                [ \t]*
+                (?<=\s)         # lookbehind for whitespace
+                ['"(]
+                ([^\n]*)        # title = \3
+                ['")]
+                [ \t]*
+            )?  # title is optional
+            (?:\n+|\Z)
+            """ % less_than_tab, re.X | re.M | re.U)
+
+        self.footnote_def_re = re.compile(r'''
+            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+            [ \t]*
+            (                       # footnote text = \2
+              # First line need not start with the spaces.
+              (?:\s*.*\n+)
+              (?:
+                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+                .*\n+
+              )*
+            )
+            # Lookahead for non-space at line-start, or end of doc.
+            (?:(?=^[ ]{0,%d}\S)|\Z)
+            ''' % (less_than_tab, tab_width, tab_width),
+            re.X | re.M)
+
+        self.code_block_re = re.compile(r'''
+            (?:\n\n|\A\n?)
+            (               # $1 = the code block -- one or more lines, starting with a space/tab
+              (?:
+                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+                .*\n+
+              )+
+            )
+            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+            # Lookahead to make sure this block isn't already in a code block.
+            # Needed when syntax highlighting is being used.
+            (?!([^<]|<(/?)span)*\</code\>)
+            ''' % (tab_width, tab_width),
+            re.M | re.X)
+
+        self.ul_list_re = self._list_re(less_than_tab, list_level,
+                                        Markdown._marker_ul, Markdown._marker_ol)
+        self.ol_list_re = self._list_re(less_than_tab, list_level,
+                                        Markdown._marker_ol, Markdown._marker_ul)
+
+        self.hr_tag_re = _hr_tag_re_from_tab_width(tab_width)
+        self.xml_oneliner_re = _xml_oneliner_re_from_tab_width(tab_width)
+        self.outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+
+        self.table_re = re.compile(r'''
+                (?:(?<=\n)|\A\n?)             # leading blank line
+
+                ^[ ]{0,%d}                      # allowed whitespace
+                (.*[|].*)[ ]*\n                   # $1: header row (at least one pipe)
+
+                ^[ ]{0,%d}                      # allowed whitespace
+                (                               # $2: underline row
+                    # underline row with leading bar
+                    (?:  \|\ *:?-+:?\ *  )+  \|? \s?[ ]*\n
+                    |
+                    # or, underline row without leading bar
+                    (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )? \s?[ ]*\n
+                )
+
+                (                               # $3: data rows
+                    (?:
+                        ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
+                        .*\|.*[ ]*\n
+                    )+
+                )
+            ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+
+        self.wiki_table_re = re.compile(r'''
+            (?:(?<=\n\n)|\A\n?)            # leading blank line
+            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+            ''' % less_than_tab, re.M | re.X)
+
+        self.pyshell_block_re = re.compile(r"""
+            ^([ ]{0,%d})>>>[ ].*\n  # first line
+            ^(\1[^\S\n]*\S.*\n)*    # any number of subsequent lines with at least one character
+            (?=^\1?\n|\Z)           # ends with a blank line or end of document
+            """ % less_than_tab, re.M | re.X)
+
+        # Token predicates for `_hash_html_spans`, only needed in safe mode.
+        if safe_mode:
+            self.placeholder_token_re = re.compile(r'md5-[A-Fa-f0-9]{32}')
+            self.comment_token_re = re.compile(r'(<!--)(.*)(-->)')
+        else:
+            self.placeholder_token_re = self.comment_token_re = None
+
+    @staticmethod
+    def _list_re(less_than_tab, list_level, marker_pat, other_marker_pat):
+        whole_list = r'''
+            (                   # \1 = whole list
+              (                 # \2
+                ([ ]{0,%d})     # \3 = the indentation level of the list item marker
+                (%s)            # \4 = first list item marker
+                [ \t]+
+                (?!\ *\4\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+              )
+              (?:.+?)
+              (                 # \5
+                  \Z
+                |
+                  \n{2,}
+                  (?=\S)
+                  (?!           # Negative lookahead for another list item marker
+                    [ \t]*
+                    %s[ \t]+
+                  )
+                |
+                  \n+
+                  (?=
+                    \3          # lookahead for a different style of list item marker
+                    %s[ \t]+
+                  )
+              )
+            )
+        ''' % (less_than_tab, marker_pat, marker_pat, other_marker_pat)
+        if list_level:  # sub-list
+            return re.compile("^"+whole_list, re.X | re.M | re.S)
+        return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list, re.X | re.M | re.S)
+
+
+_patterns_registry = {}
+_patterns_lock = threading.Lock()
+
+def _patterns_for(tab_width, list_level, safe_mode):
+    """Return the shared `_Patterns` for this configuration, building it on
+    first use. Only whether `list_level` is non-zero affects the patterns.
+    """
+    key = (tab_width, bool(list_level), safe_mode)
+    try:
+        return _patterns_registry[key]
+    except KeyError:
+        pass
+    with _patterns_lock:
+        if key not in _patterns_registry:
+            _patterns_registry[key] = _Patterns(tab_width, list_level, safe_mode)
+        return _patterns_registry[key]
+
+
+def warm_up(tab_width=DEFAULT_TAB_WIDTH, safe_modes=(None, 'escape', 'replace')):
+    """Pre-build the compiled patterns for the given configurations, e.g. at
+    application start-up, so that the first `convert()` doesn't pay for
+    compiling them.
+    """
+    for safe_mode in safe_modes:
+        for list_level in (0, 1):
+            _patterns_for(tab_width, list_level, safe_mode)
+
+
 def _xml_escape_attr(attr, skip_single_quote=True):
     """Escape the given string for use in an HTML/XML tag attribute.
 
@@ -3643,18 +5353,76 @@ def _html_escape_url(attr, safe_mode=False, charset=None):
 
 # ---- mainline
 
-class _NoReflowFormatter(argparse.RawDescriptionHelpFormatter):
-    """An argparse formatter that does NOT reflow the description."""
-    def format_description(self, description):
-        return description or ""
-
-
 def _test():
     import doctest
     doctest.testmod()
 
 
+def _format_timings(timings):
+    """Format the `timings` of a profiled conversion as a table, slowest
+    first. Stage times include the stages nested in them.
+    """
+    lines = ["%-32s %8s %12s" % ("stage/extra", "calls", "total ms")]
+    for label, (calls, seconds) in sorted(timings.items(), key=lambda item: -item[1][1]):
+        lines.append("%-32s %8d %12.3f" % (label, calls, seconds * 1000))
+    return "\n".join(lines) + "\n"
+
+
+def _convert_paths(paths, opts, extras, link_patterns):
+    """Convert `paths` as a batch, `opts.jobs` at a time, writing the HTML
+    to `opts.output_dir` or, in order, to stdout.
+    """
+    import os
+    if opts.output_dir:
+        expanded = []
+        for path in paths:
+            if os.path.isdir(path):
+                expanded.extend(sorted(
+                    os.path.join(path, name) for name in os.listdir(path)
+                    if name.endswith('.md')))
+            else:
+                expanded.append(path)
+        paths = expanded
+        os.makedirs(opts.output_dir, exist_ok=True)
+
+    texts = []
+    for path in paths:
+        if path == '-':
+            texts.append(sys.stdin.read())
+        else:
+            with codecs.open(path, 'r', opts.encoding) as fp:
+                texts.append(fp.read())
+
+    htmls = markdown_many(texts, workers=opts.jobs,
+        html4tags=opts.html4tags,
+        safe_mode=opts.safe_mode,
+        extras=extras, link_patterns=link_patterns,
+        use_file_vars=opts.use_file_vars,
+        cli=True, profile=opts.profile)
+
+    for path, html in zip(paths, htmls):
+        if opts.profile:
+            sys.stderr.write("==== %s ====\n%s" % (path, _format_timings(html.timings)))
+        if not opts.output_dir:
+            sys.stdout.write(html)
+            continue
+        name = 'stdin' if path == '-' else os.path.splitext(os.path.basename(path))[0]
+        out_path = os.path.join(opts.output_dir, name + '.html')
+        with codecs.open(out_path, 'w', 'utf-8') as fp:
+            fp.write(html)
+        log.debug("wrote %s", out_path)
+
+
 def main(argv=None):
+    # argparse is only needed on the command line, so it isn't imported
+    # with the module
+    import argparse
+
+    class _NoReflowFormatter(argparse.RawDescriptionHelpFormatter):
+        """An argparse formatter that does NOT reflow the description."""
+        def format_description(self, description):
+            return description or ""
+
     if argv is None:
         argv = sys.argv
     if not logging.root.handlers:
@@ -3695,8 +5463,18 @@ def main(argv=None):
                       help="run internal self-tests (some doctests)")
     parser.add_argument("--compare", action="store_true",
                       help="run against Markdown.pl as well (for testing)")
+    parser.add_argument("--profile", action="store_true",
+                      help="print the time spent in each stage and extra "
+                           "to stderr")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+                      help="convert the files with N worker processes")
+    parser.add_argument("-o", "--output-dir", metavar="DIR",
+                      help="write each file's HTML to DIR/NAME.html instead "
+                           "of stdout. Directories among PATHS are "
+                           "expanded to the *.md files in them")
     parser.set_defaults(log_level=logging.INFO, compare=False,
-                        encoding="utf-8", safe_mode=None, use_file_vars=False)
+                        encoding="utf-8", safe_mode=None, use_file_vars=False,
+                        jobs=1, output_dir=None, profile=False)
     opts = parser.parse_args()
     paths = opts.paths
     log.setLevel(opts.log_level)
@@ -3745,6 +5523,10 @@ def main(argv=None):
                        "Markdown.pl")
     if not paths:
         paths = ['-']
+
+    if (opts.jobs > 1 or opts.output_dir) and not opts.compare:
+        return _convert_paths(paths, opts, extras, link_patterns)
+
     for path in paths:
         if path == '-':
             text = sys.stdin.read()
@@ -3761,13 +5543,23 @@ def main(argv=None):
             perl_html = p.stdout.read().decode('utf-8')
             sys.stdout.write(perl_html)
             print("==== markdown2.py ====")
+        elif not opts.profile and not (extras and "toc" in extras):
+            # write the HTML out as it's finished, rather than in one piece
+            Markdown(html4tags=opts.html4tags,
+                     safe_mode=opts.safe_mode,
+                     extras=extras, link_patterns=link_patterns,
+                     use_file_vars=opts.use_file_vars,
+                     cli=True).convert_to(text, sys.stdout)
+            continue
         html = markdown(text,
             html4tags=opts.html4tags,
             safe_mode=opts.safe_mode,
             extras=extras, link_patterns=link_patterns,
             use_file_vars=opts.use_file_vars,
-            cli=True)
+            cli=True, profile=opts.profile)
         sys.stdout.write(html)
+        if opts.profile:
+            sys.stderr.write(_format_timings(html.timings))
         if extras and "toc" in extras:
             log.debug("toc_html: " +
                 str(html.toc_html.encode(sys.stdout.encoding or "utf-8", 'xmlcharrefreplace')))
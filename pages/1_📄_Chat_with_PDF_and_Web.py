@@ -2,11 +2,13 @@ import os
 import queue
 import re
 import tempfile
+import textwrap
 import threading
 import requests
 
 import streamlit as st
-import markdown2
+
+from rendering import conversation_html, render_markdown, stream_renderer
 
 from embedchain import App
 from embedchain.config import BaseLlmConfig
@@ -221,17 +223,18 @@ site:www.cell.com OR site:www.nature.com OR site:www.springer.com OR site:www.wi
         st.session_state.messages_pdf = [
             {
                 "role": "assistant",
-                "content": """
+                # dedented, or the indentation would make it a code block
+                "content": textwrap.dedent("""
                     Hi! I'm an AI chatbot running the latest OpenAI GPT-4o model. I can answer questions about your pdfs or web search results.\n
                     Please upload your ⬅️ pdfs, or search the ⬅️ web and I'll answer questions about the content. 
-                """,
+                """),
             }
         ]
 
     for message in st.session_state.messages_pdf:
         if message["role"] != "system":
             with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+                st.markdown(render_markdown(message["content"]), unsafe_allow_html=True)
 
     prompt_guidance = "\n\n" + """Please structure your response into two distinct sections:\n
                 ## Contextual Response:\n
@@ -250,7 +253,7 @@ site:www.cell.com OR site:www.nature.com OR site:www.springer.com OR site:www.wi
 
         with st.chat_message("user"):
             st.session_state.messages_pdf.append({"role": "user", "content": prompt})
-            st.markdown(prompt)
+            st.markdown(render_markdown(prompt), unsafe_allow_html=True)
 
         with st.chat_message("assistant"):
             msg_placeholder = st.empty()
@@ -272,9 +275,10 @@ site:www.cell.com OR site:www.nature.com OR site:www.springer.com OR site:www.wi
             thread = threading.Thread(target=app_response, args=(results,))
             thread.start()
 
+            renderer = stream_renderer()
             for answer_chunk in generate(q):
                 full_response += answer_chunk
-                msg_placeholder.markdown(full_response)
+                msg_placeholder.markdown(renderer.feed(answer_chunk), unsafe_allow_html=True)
 
             thread.join()
             answer, citations = results["answer"], results["citations"]
@@ -294,7 +298,8 @@ site:www.cell.com OR site:www.nature.com OR site:www.springer.com OR site:www.wi
             # st.write(f' here are the full {citations}')
             
             refine_output(citations)
-            msg_placeholder.markdown(full_response)
+            # the sources weren't streamed: convert the finished reply once
+            msg_placeholder.markdown(render_markdown(full_response), unsafe_allow_html=True)
             # print("Answer: ", full_response)
             st.session_state.messages_pdf.append({"role": "assistant", "content": full_response})
     
@@ -323,14 +328,12 @@ site:www.cell.com OR site:www.nature.com OR site:www.springer.com OR site:www.wi
     if st.session_state.messages_pdf:    
         if st.sidebar.button("Clear chat history."):
             st.session_state["messages_pdf"] = []
+            st.session_state["pdf_conversation_export"] = {}
             
     if st.session_state.messages_pdf:
-        pdf_conversation_str = "\n\n".join(
-            f"👩‍⚕️: {msg['content']}" if msg["role"] == "user" else f"🤓: {msg['content']}"
-            for msg in st.session_state.messages_pdf
-        )
-        html = markdown2.markdown(pdf_conversation_str, extras=["tables"])
-        st.download_button('Download the PDF conversation', html, f'pdf_conversation.html', 'text/html')
+        if st.button('Prepare the PDF conversation for download'):
+            html = conversation_html(st.session_state.messages_pdf, st.session_state.setdefault("pdf_conversation_export", {}))
+            st.download_button('Download the PDF conversation', html, f'pdf_conversation.html', 'text/html')
 
 # @misc{embedchain,
 #   author = {Taranjeet Singh, Deshraj Yadav},
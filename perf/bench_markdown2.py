@@ -0,0 +1,975 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for the hot paths in markdown2.py.
+
+Usage:
+    python perf/bench_markdown2.py              # run every benchmark
+    python perf/bench_markdown2.py unescape     # run the named benchmarks
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import markdown2  # noqa: E402
+
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def best_of(func, number=5, repeat=3):
+    """Best per-call time of `func` in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def report(label, seconds, baseline=None):
+    line = '  %-40s %10.3f ms' % (label, seconds * 1000)
+    if baseline:
+        line += '  (%.1fx)' % (baseline / seconds)
+    print(line)
+
+
+class _CaptureMarkdown(markdown2.Markdown):
+    """Keeps the hashed text as it was just before placeholders are restored."""
+    def postprocess(self, text):
+        self.hashed_text = text
+        return text
+
+
+def llm_answer(sections=50):
+    """A long, LLM-style answer: headers, lists, a table and lots of code
+    spans, links and escapes."""
+    parts = []
+    for i in range(sections):
+        parts.append('## Section %d\n' % i)
+        parts.append('Call `func_%d(x)` or `other_%d()` \\*not em\\* and see '
+                     '[the docs](http://example.com/%d?a=1&b=2 "Docs") for '
+                     '**details** on <http://example.com/raw/%d>.\n' % (i, i, i, i))
+        parts.append('- item with `code` one\n- item _two_ with a [link](http://x.org/%d)\n'
+                     '- item three\n' % i)
+        parts.append('| Drug | Dose | Notes |\n|---|:---:|---|\n'
+                     '| `a%d` | 1 mg | *ok* |\n| b | 2 mg | [ref](http://r.org) |\n' % i)
+    return '\n'.join(parts)
+
+
+# ---- benchmarks
+
+def _legacy_unescape_special_chars(md, text):
+    hashmap = tuple(md._escape_table.items()) + tuple(md._code_table.items())
+    hashmap += tuple(tuple(reversed(i)) for i in md.html_blocks.items())
+    while True:
+        orig_text = text
+        for ch, hash in hashmap:
+            text = text.replace(hash, ch)
+        if text == orig_text:
+            break
+    return text
+
+
+@benchmark
+def bench_unescape():
+    """Placeholder restoration on a document with thousands of hashed spans."""
+    md = _CaptureMarkdown(extras=['tables'])
+    md.convert(llm_answer(sections=400))
+    text = md.hashed_text
+    print('  %d hashed spans' % len(md._hash_re.findall(text)))
+    legacy = best_of(lambda: _legacy_unescape_special_chars(md, text), number=1)
+    current = best_of(lambda: md._unescape_special_chars(text), number=1)
+    assert md._unescape_special_chars(text) == _legacy_unescape_special_chars(md, text)
+    report('replace loop over every key', legacy)
+    report('single regex scan', current, legacy)
+
+
+class _Sha256Markdown(markdown2.Markdown):
+    """Hashes placeholders with SHA-256, as markdown2 did before the
+    per-instance allocator."""
+    def _hash_text(self, s):
+        return markdown2._hash_text(s)
+
+
+@benchmark
+def bench_placeholders():
+    """SHA-256 placeholders vs the per-instance counter allocator."""
+    spans = ['`code_%d(x)`' % i for i in range(20000)]
+
+    def allocate():
+        md = markdown2.Markdown()
+        return [md._hash_text(s) for s in spans]
+
+    sha = best_of(lambda: [markdown2._hash_text(s) for s in spans], number=1)
+    counter = best_of(allocate, number=1)
+    report('sha256 of 20000 spans', sha)
+    report('counter allocator for 20000 spans', counter, sha)
+
+    text = llm_answer(sections=200)
+    sha = best_of(lambda: _Sha256Markdown(extras=['tables']).convert(text), number=1)
+    counter = best_of(lambda: markdown2.Markdown(extras=['tables']).convert(text), number=1)
+    report('convert, sha256 placeholders', sha)
+    report('convert, counter placeholders', counter, sha)
+
+
+@benchmark
+def bench_patterns():
+    """First convert() with cold vs warmed-up compiled patterns."""
+    import re
+    text = llm_answer(sections=1)
+
+    def cold():
+        re.purge()
+        markdown2._patterns_registry.clear()
+        return markdown2.Markdown(extras=['tables']).convert(text)
+
+    def warm():
+        return markdown2.Markdown(extras=['tables']).convert(text)
+
+    cold_time = best_of(cold, number=20)
+    markdown2.warm_up()
+    warm_time = best_of(warm, number=20)
+    report('short reply, nothing compiled', cold_time)
+    report('short reply, after warm_up()', warm_time, cold_time)
+
+
+class _RegistryWalkMarkdown(markdown2.Markdown):
+    """Recompiles the extra plan on every stage call, which costs about what
+    walking `Extra._exec_order` in `mark_stage` used to."""
+    @property
+    def _extra_plan_version(self):
+        return -1
+
+    @_extra_plan_version.setter
+    def _extra_plan_version(self, value):
+        pass
+
+
+@benchmark
+def bench_extra_plan():
+    """Stage dispatch through the compiled per-instance extra plan."""
+    text = llm_answer(sections=200)
+    extras = ['tables', 'fenced-code-blocks', 'strike', 'task_list']
+    walk = best_of(lambda: _RegistryWalkMarkdown(extras=extras).convert(text), number=1)
+    plan = best_of(lambda: markdown2.Markdown(extras=extras).convert(text), number=1)
+    report('registry walk per stage call', walk)
+    report('compiled extra plan', plan, walk)
+
+
+@benchmark
+def bench_pool():
+    """markdown() on one-line chat messages, where converter setup shows:
+    new converter per call vs pooled one."""
+    messages = ['**User:** is %d mg of *ibuprofen* safe?' % i for i in range(200)]
+    extras = ['tables', 'fenced-code-blocks', 'header-ids']
+
+    def fresh():
+        for text in messages:
+            markdown2.Markdown(extras=extras).convert(text)
+
+    def pooled():
+        for text in messages:
+            markdown2.markdown(text, extras=extras)
+
+    fresh_time = best_of(fresh, number=3, repeat=5)
+    max_entries, markdown2.render_cache.max_entries = markdown2.render_cache.max_entries, 0
+    try:
+        assert ([markdown2.markdown(text, extras=extras) for text in messages]
+                == [markdown2.Markdown(extras=extras).convert(text) for text in messages])
+        pooled_time = best_of(pooled, number=3, repeat=5)
+    finally:
+        markdown2.render_cache.max_entries = max_entries
+    report('Markdown(...).convert() x200', fresh_time)
+    report('pooled markdown() x200', pooled_time, fresh_time)
+
+
+@benchmark
+def bench_render_cache():
+    """Re-rendering an unchanged conversation on every rerun."""
+    conversation = '\n\n'.join(llm_answer(sections=5) for _ in range(20))
+
+    def miss():
+        markdown2.render_cache.clear()
+        return markdown2.markdown(conversation, extras=['tables'])
+
+    def hit():
+        return markdown2.markdown(conversation, extras=['tables'])
+
+    miss_time = best_of(miss, number=1)
+    hit_time = best_of(hit)
+    report('cache miss', miss_time)
+    report('cache hit', hit_time, miss_time)
+    print('  hits %d, misses %d' % (markdown2.render_cache.hits, markdown2.render_cache.misses))
+
+
+@benchmark
+def bench_many():
+    """Bulk conversion of archived conversations: serial vs markdown_many()."""
+    texts = [llm_answer(sections=20) for _ in range(64)]
+
+    serial = best_of(lambda: [markdown2.Markdown(extras=['tables']).convert(t) for t in texts],
+                     number=1, repeat=1)
+    report('64 documents, serial', serial)
+    for workers in (2, 4):
+        parallel = best_of(lambda: markdown2.markdown_many(texts, workers=workers, extras=['tables']),
+                           number=1, repeat=1)
+        report('64 documents, %d workers' % workers, parallel, serial)
+
+
+@benchmark
+def bench_engine():
+    """Block gamut on a long answer: regex engine vs engine="linear"."""
+    text = llm_answer(sections=400)
+    regex = best_of(lambda: markdown2.Markdown(extras=['tables']).convert(text), number=1)
+    linear = best_of(lambda: markdown2.Markdown(extras=['tables'], engine='linear').convert(text),
+                     number=1)
+    assert (markdown2.Markdown(extras=['tables']).convert(text)
+            == markdown2.Markdown(extras=['tables'], engine='linear').convert(text))
+    report('400 sections, engine="regex"', regex)
+    report('400 sections, engine="linear"', linear, regex)
+
+
+class _LegacyEscapesMarkdown(markdown2.Markdown):
+    """Tries every `_escape_table` key (including every URL seen so far)
+    against every span, as `_encode_backslash_escapes` used to."""
+    def _encode_backslash_escapes(self, text):
+        for ch, escape in list(self._escape_table.items()):
+            text = text.replace("\\"+ch, escape)
+        return text
+
+
+def short_paragraphs(count=5000):
+    """Many short chat-style paragraphs, most with little or no markup."""
+    kinds = ['Short reply %d about the dose.',
+             'Take `%d mg` **twice** daily, see [docs](http://x.org/%d).',
+             'Okay & thanks <3 (%d)',
+             'Plain text line here with nothing special %d']
+    return '\n\n'.join(kinds[i % 4].replace('%d', str(i)) for i in range(count))
+
+
+@benchmark
+def bench_span_gamut():
+    """Span gamut on thousands of short paragraphs."""
+    text = short_paragraphs()
+    legacy = best_of(lambda: _LegacyEscapesMarkdown().convert(text), number=1)
+    current = best_of(lambda: markdown2.Markdown().convert(text), number=1)
+    report('5000 paragraphs, escape table scan', legacy)
+    report('5000 paragraphs, current', current, legacy)
+
+
+# Pathological inputs, as a function of size: each made the regex engine
+# rescan the rest of the text at every repetition (or, for tag_attrs,
+# backtrack exponentially).
+ADVERSARIAL = {
+    'unclosed_divs': lambda n: '<div>\n\n' * n,
+    'unclosed_em': lambda n: '*a ' * n,
+    'unclosed_strong': lambda n: '**a ' * n,
+    'open_brackets': lambda n: '[' * n,
+    'unclosed_fence': lambda n: '```\n' + '\n' * n,
+    'tag_attrs': lambda n: '<a ' + 'b="c" ' * (n // 100) + '\n',
+    'nested_quotes': lambda n: '>' * n + ' a\n',
+}
+
+
+@benchmark
+def bench_adversarial():
+    """Pathological input: default vs hardened=True, and a deadline."""
+    extras = ['fenced-code-blocks', 'tables']
+    for name, make in ADVERSARIAL.items():
+        times = []
+        for n in (2000, 4000):
+            text = make(n)
+            times.append(best_of(lambda: markdown2.Markdown(extras=extras, hardened=True).convert(text),
+                                 number=1, repeat=1))
+        if name in ('tag_attrs', 'nested_quotes'):
+            # exponential time / RecursionError without hardened=True
+            default = None
+        else:
+            text = make(4000)
+            default = best_of(lambda: markdown2.Markdown(extras=extras).convert(text),
+                              number=1, repeat=1)
+            report('%s n=4000, default' % name, default)
+        report('%s n=2000, hardened' % name, times[0])
+        report('%s n=4000, hardened' % name, times[1], default)
+
+    # the deadline is checked between stages, so it bounds many slow
+    # paragraphs rather than one slow regex
+    text = '\n\n'.join([ADVERSARIAL['unclosed_em'](1000)] * 200)
+    default = best_of(lambda: markdown2.Markdown().convert(text), number=1, repeat=1)
+    deadline = best_of(lambda: markdown2.Markdown().convert(text, deadline=0.05),
+                       number=1, repeat=1)
+    assert markdown2.Markdown().convert(text, deadline=0.05).timed_out
+    report('200 x unclosed_em n=1000, default', default)
+    report('200 x unclosed_em n=1000, deadline=0.05', deadline, default)
+
+
+def mixed_headers(sections=300):
+    """Markdown headers interleaved with raw HTML ones."""
+    parts = []
+    for i in range(sections):
+        parts.append('<h2>HTML header %d</h2>\n\n## Markdown header %d\n\nSome text.\n\n'
+                     '<h3 id="custom-%d">Custom id</h3>\n\nSetext %d\n---------\n' % (i, i, i, i))
+    return '\n'.join(parts)
+
+
+@benchmark
+def bench_toc():
+    """Ordering the TOC with header-ids "mixed": a regex search per entry
+    vs one scan for every header."""
+    md = markdown2.Markdown(extras={'toc': None, 'header-ids': {'mixed': True}})
+    html = md.convert(mixed_headers())
+    toc = list(md._toc)
+    print('  %d TOC entries' % len(toc))
+
+    def per_entry():
+        return sorted(toc, key=lambda entry: re.search(
+            r'^<(h%d).*?id=(["\'])%s\2.*>%s</\1>$' % (entry[0], entry[1], re.escape(entry[2])),
+            html, re.M).start())
+
+    def one_scan():
+        positions = {}
+        for match in md._toc_header_re.finditer(html):
+            positions.setdefault((int(match.group(1)), match.group(3)), match.start())
+        return sorted(toc, key=lambda entry: positions[entry[:2]])
+
+    assert per_entry() == one_scan()
+    legacy = best_of(per_entry, number=1)
+    current = best_of(one_scan, number=1)
+    report('re.search per entry', legacy)
+    report('one finditer over the output', current, legacy)
+
+
+class _UncachedPygmentsMarkdown(markdown2.Markdown):
+    """Looks up the lexer, defines the formatter class and highlights the
+    code again for every fenced block, as markdown2 did before the caches."""
+    def _get_pygments_lexer(self, lexer_name):
+        from pygments import lexers, util
+        try:
+            return lexers.get_lexer_by_name(lexer_name)
+        except util.ClassNotFound:
+            return None
+
+    def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
+        import pygments
+        base = markdown2._html_code_formatter_class()
+        formatter_class = type('HtmlCodeFormatter', (base,), {})
+        formatter_opts.setdefault("cssclass", "codehilite")
+        return pygments.highlight(codeblock, lexer, formatter_class(**formatter_opts))
+
+
+def requoted_code(turns=40):
+    """A conversation where the same few snippets keep being quoted back."""
+    snippets = [
+        'def dose(weight_kg, mg_per_kg=%d):\n    return weight_kg * mg_per_kg\n' % i
+        for i in range(5)]
+    parts = []
+    for i in range(turns):
+        parts.append('Turn %d, here is the helper again:\n\n'
+                     '```python\n%s```\n' % (i, snippets[i % len(snippets)]))
+    return '\n'.join(parts)
+
+
+@benchmark
+def bench_pygments():
+    """Highlighting fenced code that is quoted again and again."""
+    try:
+        import pygments  # noqa: F401
+    except ImportError:
+        print('  skipped: pygments is not installed')
+        return
+    text = requoted_code()
+    extras = ['fenced-code-blocks']
+    legacy_md = _UncachedPygmentsMarkdown(extras=extras)
+    md = markdown2.Markdown(extras=extras)
+    assert legacy_md.convert(text) == md.convert(text)
+    legacy = best_of(lambda: legacy_md.convert(text), number=3)
+    current = best_of(lambda: md.convert(text), number=3)
+    report('lookup and highlight per block', legacy)
+    report('cached lexer, formatter and output', current, legacy)
+
+
+class _LegacySafeModeMarkdown(markdown2.Markdown):
+    """Checks for code spans by joining neighbouring tokens, and restores
+    sanitized spans with a str.replace() of the whole text per span."""
+    _code_span_token_re = re.compile(r'<code>md5-[A-Fa-f0-9]{32}</code>')
+
+    def _hash_html_spans(self, text):
+        def _is_code_span(index, token):
+            if token == '<code>':
+                peek_tokens = split_tokens[index: index + 3]
+            elif token == '</code>':
+                peek_tokens = split_tokens[index - 2: index + 1]
+            else:
+                return False
+            return self._code_span_token_re.match(''.join(peek_tokens))
+
+        def _hash(token):
+            key = self._hash_text(token)
+            self.html_spans[key] = token
+            return key
+
+        tokens = []
+        split_tokens = self._sorta_html_tokenize_re.split(text)
+        is_html_markup = False
+        for index, token in enumerate(split_tokens):
+            if (is_html_markup and not self._auto_link_re.match(token)
+                    and not _is_code_span(index, token)):
+                is_comment = (self.safe_mode != 'replace'
+                              and self._patterns.comment_token_re.match(token))
+                if is_comment:
+                    tokens.append(_hash(self._sanitize_html(is_comment.group(1))))
+                    tokens.append(self._sanitize_html(is_comment.group(2)))
+                    tokens.append(_hash(self._sanitize_html(is_comment.group(3))))
+                else:
+                    tokens.append(_hash(self._sanitize_html(token)))
+            else:
+                tokens.append(self._encode_incomplete_tags(token))
+            is_html_markup = not is_html_markup
+        return ''.join(tokens)
+
+    def _unhash_html_spans(self, text):
+        for key, sanitized in list(self.html_spans.items()):
+            text = text.replace(key, sanitized)
+        return text
+
+
+def web_snippets(count=300):
+    """Search-result snippets as they come back from a web search: short
+    paragraphs with inline HTML, code and links."""
+    snippets = []
+    for i in range(count):
+        snippets.append(
+            'Result %d: <b>aspirin</b> dosing for <i>adults</i> is `%d mg` '
+            'every 4-6 hours <span class="hl">as needed</span>. See '
+            '<a href="https://example.com/%d">the label</a> <br/> and '
+            '[guidance](https://example.org/%d) for *children*.' % (i, i, i, i))
+    return '\n\n'.join(snippets)
+
+
+@benchmark
+def bench_safe_mode():
+    """safe_mode="escape" on untrusted web snippets."""
+    text = web_snippets()
+    legacy_md = _LegacySafeModeMarkdown(safe_mode='escape')
+    md = markdown2.Markdown(safe_mode='escape')
+    unsafe_md = markdown2.Markdown()
+    assert legacy_md.convert(text) == md.convert(text)
+    legacy = best_of(lambda: legacy_md.convert(text), number=3)
+    current = best_of(lambda: md.convert(text), number=3)
+    unsafe = best_of(lambda: unsafe_md.convert(text), number=3)
+    report('join + match, replace per span', legacy)
+    report('index checks, one-pass restore', current, legacy)
+    report('(unsafe mode, for reference)', unsafe)
+
+
+class _LegacyLinkPatterns(markdown2.LinkPatterns):
+    """Scans once per pattern, rescans the whole text for existing links per
+    match and splices each link in with slicing."""
+    def run(self, text):
+        link_from_hash = {}
+        for regex, repl in self.options:
+            replacements = []
+            for match in regex.finditer(text):
+                if any(self.md._match_overlaps_substr(text, match, h) for h in link_from_hash):
+                    continue
+                href = repl(match) if callable(repl) else match.expand(repl)
+                replacements.append((match.span(), href))
+            for (start, end), href in reversed(replacements):
+                if text[start - 1:start] == '[' and text[end:end + 1] == ']':
+                    continue
+                if text[start - 2:start] == '](' or text[end:end + 2] == '")':
+                    continue
+                if text[start - 3:start] == '"""' and text[end:end + 3] == '"""':
+                    text = text[:start - 3] + text[start:end] + text[end + 3:]
+                    continue
+                if any(r[0] <= start and end <= r[1]
+                       for link_re in (self.md._auto_link_re, self._basic_link_re)
+                       for match in link_re.finditer(text) for r in match.regs):
+                    continue
+                escaped_href = (
+                    href.replace('"', '&quot;')
+                        .replace('*', self.md._escape_table['*'])
+                        .replace('_', self.md._escape_table['_']))
+                link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
+                hash = self.md._hash_text(link)
+                link_from_hash[hash] = link
+                text = text[:start] + hash + text[end:]
+        for hash, link in list(link_from_hash.items()):
+            text = text.replace(hash, link)
+        return text
+
+
+DRUGS = ['aspirin', 'ibuprofen', 'naproxen', 'metformin', 'lisinopril', 'atorvastatin',
+         'amlodipine', 'omeprazole', 'losartan', 'warfarin', 'apixaban', 'insulin']
+
+
+def drug_mentions(paragraphs=200):
+    """An answer that mentions drug names all the way through, with a few
+    Markdown links among them."""
+    parts = []
+    for i in range(paragraphs):
+        a, b = DRUGS[i % len(DRUGS)], DRUGS[(i * 5 + 3) % len(DRUGS)]
+        parts.append('Compared with %s, %s lowers the risk in [trial %d](https://example.org/%d) '
+                     'but %s interacts with %s.' % (a, b, i, i, b, a))
+    return '\n\n'.join(parts)
+
+
+@benchmark
+def bench_link_patterns():
+    """link-patterns auto-linking a list of drug names."""
+    patterns = [(re.compile(r'\b%s\b' % name, re.I), 'https://example.com/drugs/' + name)
+                for name in DRUGS]
+    md = markdown2.Markdown(extras=['link-patterns'], link_patterns=patterns)
+    md.convert('')
+    text = drug_mentions()
+    legacy_extra = _LegacyLinkPatterns(md, patterns)
+    extra = markdown2.LinkPatterns(md, patterns)
+    assert legacy_extra.run(text) == extra.run(text)
+    legacy = best_of(lambda: legacy_extra.run(text), number=1)
+    current = best_of(lambda: extra.run(text), number=3)
+    report('scan per pattern, rescan per match', legacy)
+    report('pass per pattern, interval index, one join', current, legacy)
+
+
+class _LegacyCommentMarkdown(markdown2.Markdown):
+    """Hashes standalone HTML comments by rebuilding the whole text for each
+    one, before the rest of `_hash_html_blocks` runs."""
+    def _hash_html_blocks(self, text, raw=False):
+        start = 0
+        while '<!--' in text:
+            try:
+                start_idx = text.index('<!--', start)
+                end_idx = text.index('-->', start_idx) + 3
+            except ValueError:
+                break
+            start = end_idx
+            if start_idx and text[start_idx - 2:start_idx] != '\n\n':
+                break
+            if text[end_idx:end_idx + 2] not in ('', '\n', '\n\n'):
+                continue
+            html = text[start_idx:end_idx]
+            key = self._hash_text(html)
+            self.html_blocks[key] = html
+            text = text[:start_idx] + '\n\n' + key + '\n\n' + text[end_idx:]
+        return super()._hash_html_blocks(text, raw)
+
+
+class _LegacyNumbering(markdown2.Numbering):
+    """Splices each figure and each reference into the text one at a time."""
+    def run(self, text):
+        counters = {}
+        references = {}
+        replacements = []
+        definition_html = '<figcaption class="{}" id="counter-ref-{}">{}{}{}</figcaption>'
+        reference_html = '<a class="{}" href="#counter-ref-{}">{}</a>'
+        for match in self._defns_re.finditer(text):
+            counter, text_before, ref_id, text_after = match.groups()
+            number = counters.get(counter, 1)
+            references[ref_id] = (number, counter)
+            replacements.append((match.start(), definition_html.format(
+                counter, ref_id, text_before.strip(), number, text_after), match.end()))
+            counters[counter] = number + 1
+        for start, repl, end in reversed(replacements):
+            text = text[:start] + repl + text[end:]
+        for match in reversed(list(self._subs_re.finditer(text))):
+            number, counter = references.get(match.group(1), (None, None))
+            if number is not None:
+                repl = reference_html.format(counter, match.group(1), number)
+            else:
+                repl = reference_html.format(match.group(1), 'countererror',
+                                             '?' + match.group(1) + '?')
+            text = text[:match.start()] + repl + text[match.end():]
+        return text
+
+
+def figures_and_comments(sections=1000):
+    """An answer quoting HTML: a comment, a numbered figure and references
+    back to earlier figures in every section."""
+    parts = []
+    for i in range(sections):
+        parts.append('<!-- section %d: generated from the source page -->' % i)
+        parts.append('[#figure Figure @fig%d: dose response %d]' % (i, i))
+        parts.append('As [@fig%d] shows, and unlike [@fig%d], the curve flattens.'
+                     % (i, max(0, i - 1)))
+    return '\n\n'.join(parts) + '\n'
+
+
+@benchmark
+def bench_splices():
+    """Standalone comments and numbering on a document with a thousand of
+    each: splicing per edit vs one join over an edit list."""
+    text = figures_and_comments()
+    legacy_md = _LegacyCommentMarkdown()
+    md = markdown2.Markdown()
+    assert legacy_md.convert(text) == md.convert(text)
+    legacy = best_of(lambda: legacy_md.convert(text), number=1)
+    current = best_of(lambda: md.convert(text), number=1)
+    report('comments: rebuild per comment', legacy)
+    report('comments: one join', current, legacy)
+
+    legacy_numbering = _LegacyNumbering(md, None)
+    numbering = markdown2.Numbering(md, None)
+    assert legacy_numbering.run(text) == numbering.run(text)
+    legacy = best_of(lambda: legacy_numbering.run(text), number=3)
+    current = best_of(lambda: numbering.run(text), number=3)
+    report('numbering: splice per edit', legacy)
+    report('numbering: one join per pass', current, legacy)
+
+
+class _FileSink(object):
+    """Stands in for a file or socket: counts what's written, keeps none of it."""
+    def __init__(self):
+        self.written = 0
+
+    def write(self, s):
+        self.written += len(s)
+
+
+@benchmark
+def bench_stream():
+    """Peak memory converting a long export: convert() and write vs
+    convert_to() streaming into the writer."""
+    import tracemalloc
+    text = llm_answer(sections=800)
+    md = markdown2.Markdown(extras=['footnotes'])
+    print('  %.1f MB of Markdown' % (len(text) / 1e6))
+
+    def peak(func):
+        tracemalloc.start()
+        func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak_bytes
+
+    whole, streamed = _FileSink(), _FileSink()
+    legacy = peak(lambda: whole.write(md.convert(text)))
+    current = peak(lambda: md.convert_to(text, streamed))
+    assert whole.written == streamed.written
+    print('  %-40s %10.1f MB' % ('convert() then write', legacy / 1e6))
+    print('  %-40s %10.1f MB  (%.1fx less)' % ('convert_to()', current / 1e6, legacy / current))
+
+
+@benchmark
+def bench_parse_render():
+    """Re-rendering a stored conversation: convert() every time vs render()
+    of a pickled Document from parse()."""
+    import pickle
+    text = llm_answer()
+    md = markdown2.Markdown(extras=['tables', 'fenced-code-blocks', 'toc', 'html-classes'])
+    stored = pickle.dumps(md.parse(text))
+    assert md.render(pickle.loads(stored)) == md.convert(text)
+    print('  pickled Document: %.1f KB for %.1f KB of Markdown'
+          % (len(stored) / 1e3, len(text) / 1e3))
+    legacy = best_of(lambda: md.convert(text))
+    current = best_of(lambda: md.render(pickle.loads(stored)))
+    report('convert()', legacy)
+    report('render(pickle.loads(...))', current, legacy)
+    report('render_text(pickle.loads(...))', best_of(lambda: md.render_text(pickle.loads(stored))))
+
+
+@benchmark
+def bench_incremental():
+    """Rendering a reply as it streams in, 5 characters at a time: convert()
+    of everything so far vs IncrementalMarkdown.feed()."""
+    for label, text in (('LLM answer', llm_answer(sections=10)),
+                        ('loose list', ''.join('%d. Take `dose_%d` with *food*.\n\n' % (i, i)
+                                               for i in range(1, 81)))):
+        chunks = [text[pos:pos + 5] for pos in range(0, len(text), 5)]
+        md = markdown2.Markdown()
+        im = markdown2.IncrementalMarkdown()
+
+        def whole():
+            for end in range(5, len(text) + 5, 5):
+                md.convert(text[:end])
+
+        def incremental():
+            im.reset()
+            for chunk in chunks:
+                im.feed(chunk)
+
+        incremental()
+        assert im.feed('') == md.convert(text)
+        legacy = best_of(whole, number=1)
+        current = best_of(incremental, number=1)
+        report('%s: convert() per chunk' % label, legacy)
+        report('%s: feed() per chunk' % label, current, legacy)
+
+
+class _LegacyTables(markdown2.Tables):
+    """Splits each row with a chain of regex substitutions and runs the span
+    gamut on every cell on its own."""
+    def sub(self, match):
+        trim_space_re = '^[ \t\n]+|[ \t\n]+$'
+        trim_bar_re = r'^\||\|$'
+        split_bar_re = r'^\||(?<![\`\\])\|'
+        escape_bar_re = r'\\\|'
+
+        def cells(line):
+            line = re.sub(trim_bar_re, "", re.sub(trim_space_re, "", line))
+            return [re.sub(escape_bar_re, '|', cell.strip()) for cell in re.split(split_bar_re, line)]
+
+        head, underline, body = match.groups()
+        align_from_col_idx = {}
+        for col_idx, col in enumerate(cells(underline)):
+            if col[0] == ':' and col[-1] == ':':
+                align_from_col_idx[col_idx] = ' style="text-align:center;"'
+            elif col[0] == ':':
+                align_from_col_idx[col_idx] = ' style="text-align:left;"'
+            elif col[-1] == ':':
+                align_from_col_idx[col_idx] = ' style="text-align:right;"'
+
+        hlines = ['<table%s>' % self.md._html_class_str_from_tag('table'),
+                  '<thead%s>' % self.md._html_class_str_from_tag('thead'), '<tr>']
+        for col_idx, col in enumerate(cells(head)):
+            hlines.append('  <th%s>%s</th>' % (
+                align_from_col_idx.get(col_idx, ''), self.md._run_span_gamut(col)))
+        hlines.extend(('</tr>', '</thead>', '<tbody>'))
+        for line in body.strip('\n').split('\n'):
+            hlines.append('<tr>')
+            for col_idx, col in enumerate(cells(line)):
+                hlines.append('  <td%s>%s</td>' % (
+                    align_from_col_idx.get(col_idx, ''), self.md._run_span_gamut(col)))
+            hlines.append('</tr>')
+        hlines.extend(('</tbody>', '</table>'))
+        return '\n'.join(hlines) + '\n'
+
+
+def comparison_table(rows=1000, cols=10):
+    """The kind of table the expert prompt asks for: short cells, some bold,
+    code, links and numbers."""
+    cells = ['Aspirin', '**Yes**', 'No', '10 mg b.i.d.', '`CYP3A4`', 'n/a', '*rarely*',
+             '[label](https://www.fda.gov/drugs)', 'GI upset, rash', '< 5%', 'A & B', '2.5']
+    lines = ['| ' + ' | '.join('Column %d' % i for i in range(cols)) + ' |',
+             '|' + '|'.join((':---', '---:', ':---:')[i % 3] for i in range(cols)) + '|']
+    for row in range(rows):
+        lines.append('| ' + ' | '.join(cells[(row * 7 + col * 5) % len(cells)]
+                                       for col in range(cols)) + ' |')
+    return 'Comparison:\n\n' + '\n'.join(lines) + '\n\nSummary.\n'
+
+
+@benchmark
+def bench_tables():
+    """A 1,000 row by 10 column table: span gamut per cell vs batched over
+    the cells of the table."""
+    text = comparison_table()
+    md = markdown2.Markdown(extras=['tables'])
+    md.convert('')
+    legacy_extra = _LegacyTables(md, None)
+    extra = markdown2.Tables(md, None)
+    assert legacy_extra.run(text) == extra.run(text)
+    legacy = best_of(lambda: legacy_extra.run(text), number=1)
+    current = best_of(lambda: extra.run(text), number=1)
+    report('regex row splits, span gamut per cell', legacy)
+    report('batched span gamut, one join', current, legacy)
+
+
+class _UnfilteredMarkdown(markdown2.Markdown):
+    """Runs the extras that had no real `test()` on every stage input."""
+    _unfiltered = ('link-patterns', 'markdown-in-html', 'numbering', 'tables')
+
+    def _compile_extra_plan(self):
+        for name in self._unfiltered:
+            if name in self.extra_classes:
+                self.extra_classes[name].test = lambda text: True
+        super()._compile_extra_plan()
+
+
+@benchmark
+def bench_prefilters():
+    """Link patterns, numbering, markdown-in-html and tables on an answer
+    with no matches for the first three: always run vs prefiltered."""
+    patterns = [(re.compile(r'PMID:\s*(\d+)'), r'https://pubmed.ncbi.nlm.nih.gov/\1'),
+                (re.compile(r'NCT(\d{8})'), r'https://clinicaltrials.gov/study/NCT\1')]
+    kwargs = dict(extras=['link-patterns', 'markdown-in-html', 'numbering', 'tables'],
+                  link_patterns=patterns)
+    text = llm_answer(sections=200)
+    legacy_md = _UnfilteredMarkdown(**kwargs)
+    md = markdown2.Markdown(**kwargs)
+    assert legacy_md.convert(text) == md.convert(text)
+    legacy = best_of(lambda: legacy_md.convert(text), number=1)
+    current = best_of(lambda: md.convert(text), number=1)
+    report('convert(), extras always run', legacy)
+    report('convert(), prefiltered', current, legacy)
+
+
+def _legacy_detab_line(md, line):
+    if '\t' not in line:
+        return line
+    chunk1, chunk2 = line.split('\t', 1)
+    chunk1 += (' ' * (md.tab_width - len(chunk1) % md.tab_width))
+    return _legacy_detab_line(md, chunk1 + chunk2)
+
+
+def _legacy_normalize_whitespace(md, text):
+    """Line endings, tabs and whitespace-only lines, one pass after another,
+    with tabs expanded by recursing on each one."""
+    text = text.replace("\r\n", "\n")
+    text = text.replace("\r", "\n")
+    text += "\n\n"
+    if '\t' in text:
+        text = '\n'.join(_legacy_detab_line(md, line) for line in text.splitlines())
+    return md._ws_only_line_re.sub("", text)
+
+
+def pasted_columns(lines=3000, columns=30):
+    """Text copied out of a PDF or spreadsheet: CRLF line endings, a tab
+    between every column and tab-only spacer lines."""
+    rows = []
+    for i in range(lines):
+        rows.append('\t'.join('r%dc%d' % (i, col) for col in range(columns)))
+        if i % 10 == 0:
+            rows.append('\t\t')
+    return '\r\n'.join(rows) + '\r\n'
+
+
+@benchmark
+def bench_preprocess():
+    """Newlines, tabs and blank lines on tab-heavy pasted text: one pass per
+    step vs one routine; then reading a large file with and without mmap."""
+    import codecs
+    import tempfile
+    import tracemalloc
+    md = markdown2.Markdown()
+    text = pasted_columns()
+    assert _legacy_normalize_whitespace(md, text) == md._normalize_whitespace(text)
+    legacy = best_of(lambda: _legacy_normalize_whitespace(md, text), number=3)
+    current = best_of(lambda: md._normalize_whitespace(text), number=3)
+    report('replace, recursive detab, regex', legacy)
+    report('_normalize_whitespace()', current, legacy)
+
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.md', delete=False) as fp:
+        fp.write(llm_answer(sections=20000))
+    try:
+        def peak(func):
+            tracemalloc.start()
+            func()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak_bytes
+
+        def read():
+            with codecs.open(fp.name, 'r', 'utf-8') as f:
+                return f.read()
+
+        assert read() == markdown2._read_mapped(fp.name, 'utf-8')
+        legacy = peak(read)
+        current = peak(lambda: markdown2._read_mapped(fp.name, 'utf-8'))
+        print('  %-40s %10.1f MB' % ('read %.0f MB file' % (os.path.getsize(fp.name) / 1e6), legacy / 1e6))
+        print('  %-40s %10.1f MB  (%.1fx less)' % ('decode from mmap', current / 1e6, legacy / current))
+    finally:
+        os.unlink(fp.name)
+
+
+class _LegacySmartyPants(markdown2.SmartyPants):
+    """A pass per contraction, per quote regex and per dash or dot run."""
+    _opening_single_quote_re = re.compile(r"(?<!\S)'(?=\S)")
+    _opening_double_quote_re = re.compile(r'(?<!\S)"(?=\S)')
+    _closing_single_quote_re = re.compile(r"(?<=\S)'")
+    _closing_double_quote_re = re.compile(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
+    _apostrophe_year_re = re.compile(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
+
+    def run(self, text):
+        if "'" in text:
+            text = self._apostrophe_year_re.sub(r"&#8217;\1", text)
+            for c in self._contractions:
+                text = text.replace("'%s" % c, "&#8217;%s" % c)
+                text = text.replace("'%s" % c.capitalize(), "&#8217;%s" % c.capitalize())
+            text = self._opening_single_quote_re.sub("&#8216;", text)
+            text = self._closing_single_quote_re.sub("&#8217;", text)
+        if '"' in text:
+            text = self._opening_double_quote_re.sub("&#8220;", text)
+            text = self._closing_double_quote_re.sub("&#8221;", text)
+        text = text.replace("---", "&#8212;")
+        text = text.replace("--", "&#8211;")
+        text = text.replace("...", "&#8230;")
+        text = text.replace(" . . . ", "&#8230;")
+        text = text.replace(". . .", "&#8230;")
+        return text
+
+
+def essay(paragraphs=400):
+    """Prose of the kind the essayist prompt returns: quotations,
+    apostrophes, dashes and the odd ellipsis in every paragraph."""
+    parts = []
+    for i in range(paragraphs):
+        parts.append(
+            "Urban growth in the '%02d census -- as Jacobs wrote, \"cities have the "
+            "capability of providing something for everybody\" -- wasn't evenly spread; "
+            "the city's planners couldn't keep pace... Critics called it 'sprawl', and "
+            "the council's own report --- section %d --- agreed that it's \"the defining "
+            "problem of the decade.\"" % (i % 100, i))
+    return '\n\n'.join(parts) + '\n'
+
+
+@benchmark
+def bench_smarty_pants():
+    """Smarty-pants on an essay, run once per paragraph as it is after each
+    span gamut: ~25 passes vs one alternation."""
+    md = markdown2.Markdown(extras=['smarty-pants'])
+    md.convert('')
+    paragraphs = essay().split('\n\n')
+    legacy_extra = _LegacySmartyPants(md, None)
+    extra = markdown2.SmartyPants(md, None)
+    assert [legacy_extra.run(p) for p in paragraphs] == [extra.run(p) for p in paragraphs]
+    legacy = best_of(lambda: [legacy_extra.run(p) for p in paragraphs])
+    current = best_of(lambda: [extra.run(p) for p in paragraphs])
+    report('pass per replacement', legacy)
+    report('one table-driven pass', current, legacy)
+
+
+def _importtime(runs=7):
+    """`python -X importtime -c "import markdown2"` in fresh interpreters:
+    the best self and cumulative microseconds of each imported module."""
+    import subprocess
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=repo)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)  # time the import, not the compile
+    best = {}
+    for _ in range(runs):
+        stderr = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import markdown2'],
+            env=env, capture_output=True, text=True, check=True).stderr
+        group = []
+        for line in stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            group.append((name.strip(), (int(self_us), int(cumulative_us))))
+            if name.startswith('  '):
+                continue
+            # a top-level import, reported after everything it imported;
+            # only markdown2's count, not the interpreter's own start-up
+            if group[-1][0] == 'markdown2':
+                for key, timing in group:
+                    best[key] = min(best.get(key, timing), timing, key=lambda t: t[1])
+            group = []
+    return best
+
+
+@benchmark
+def bench_import():
+    """Cold-start cost of `import markdown2`, as `python -X importtime`
+    reports it (best of several fresh interpreters)."""
+    best = _importtime()
+    self_us, cumulative_us = best['markdown2']
+    report('markdown2 itself', self_us / 1e6)
+    report('markdown2 and its imports', cumulative_us / 1e6)
+    print('  slowest imports pulled in:')
+    others = sorted((item for item in best.items() if item[0] != 'markdown2'),
+                    key=lambda item: -item[1][1])
+    for name, (_, cumulative_us) in others[:5]:
+        report('  ' + name, cumulative_us / 1e6)
+
+
+def main(argv):
+    names = argv[1:] or list(BENCHMARKS)
+    for name in names:
+        func = BENCHMARKS[name]
+        print('%s: %s' % (name, func.__doc__))
+        func()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
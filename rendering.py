@@ -0,0 +1,33 @@
+from typing import Any, Dict, List
+
+import markdown2
+
+# One set of markdown2 options for every chat message, so a reply looks the
+# same while it streams in, once it's finished, and in the chat history.
+# safe_mode="escape" because the HTML is shown with unsafe_allow_html=True.
+MARKDOWN_OPTIONS = {"extras": ["tables", "fenced-code-blocks"], "safe_mode": "escape"}
+
+# Renderer for a reply as it streams in: feed() it each chunk, then show
+# flush() once the reply is complete
+def stream_renderer() -> markdown2.IncrementalMarkdown:
+    return markdown2.IncrementalMarkdown(**MARKDOWN_OPTIONS)
+
+# HTML for a finished message
+def render_markdown(text: str) -> str:
+    return markdown2.markdown(text, **MARKDOWN_OPTIONS)
+
+# HTML of the whole conversation for download. The transcript is converted
+# as one document, so e.g. a reference link defined in a later message
+# resolves as it would in the joined text. `cache` is a dict kept in session
+# state between exports: the transcript is only converted again once the
+# conversation has changed.
+def conversation_html(messages: List[Dict[str, Any]], cache: Dict[str, Any]) -> str:
+    parts = []
+    for msg in messages:
+        speaker = "👩‍⚕️" if msg["role"] == "user" else "🤓"
+        parts.append(f"{speaker}: {msg['content']}")
+    transcript = "\n\n".join(parts)
+    if cache.get("transcript") != transcript:
+        cache["transcript"] = transcript
+        cache["html"] = markdown2.markdown(transcript, extras=["tables"])
+    return cache["html"]